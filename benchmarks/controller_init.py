@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Times ``Controller.__init__`` plus ``_init_meta``, the work done for every request before
+the action runs, with the lazy setup and with the eager one it replaced (every component
+built, ``params`` and the session store created up front).
+
+The eager setup also used to open a Cloud SQL connection, that isn't measured here. Run it
+from the application root with the App Engine SDK on the path::
+
+    python argeweb/core/benchmarks/controller_init.py [iterations]
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+os.environ.setdefault('SERVER_NAME', 'localhost')
+os.environ.setdefault('SERVER_SOFTWARE', 'Benchmark')
+os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+
+from google.appengine.ext import testbed
+
+bed = testbed.Testbed()
+bed.activate()
+bed.init_memcache_stub()
+bed.init_datastore_v3_stub()
+
+import webapp2
+from argeweb.core import inflector
+from argeweb.core.controller import Controller
+
+
+class Benchmark(Controller):
+    def list(self):
+        pass
+
+
+class EagerBenchmark(Benchmark):
+    class Meta(Controller.Meta):
+        lazy_components = ()
+
+    def __init__(self, *args, **kwargs):
+        super(EagerBenchmark, self).__init__(*args, **kwargs)
+        self.name = inflector.underscore(self.__class__.__name__)
+        self.params
+        self.session_store
+
+
+app = webapp2.WSGIApplication(config={'webapp2_extras.sessions': {'secret_key': 'benchmark'}})
+
+
+def build_request(cls):
+    request = webapp2.Request.blank('/benchmark')
+    request.app = app
+    request.route = webapp2.Route('/benchmark', cls, name='benchmark:list', handler_method='list')
+    request.route_args = ()
+    request.route_kwargs = {}
+    return request
+
+
+def construct(cls, request):
+    app.set_globals(app=app, request=request)
+    controller = cls(request, webapp2.Response())
+    controller._init_meta()
+    return controller
+
+
+def main(iterations=2000):
+    for label, cls in (('before (eager)', EagerBenchmark), ('after (lazy)', Benchmark)):
+        request = build_request(cls)
+        construct(cls, request)
+        seconds = min(timeit.repeat(lambda: construct(cls, request), repeat=3, number=iterations))
+        print '%-16s %8.1f us per controller' % (label, seconds / iterations * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Times ``routing.auto_route`` on a cold start, in a new interpreter for every run: without a
+manifest (controllers are discovered and imported) and from a manifest, with and without
+``lazy``. Run it from the application root with the App Engine SDK on the path::
+
+    python argeweb/core/benchmarks/route_startup.py [runs]
+
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+os.environ.setdefault('SERVER_NAME', 'localhost')
+os.environ.setdefault('SERVER_SOFTWARE', 'Benchmark')
+os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+
+modes = (
+    ('without manifest', 'discover'),
+    ('manifest', 'manifest'),
+    ('manifest, lazy', 'lazy'),
+)
+
+
+def start(mode, path):
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    bed.init_datastore_v3_stub()
+
+    import webapp2
+    from argeweb.core import routing
+    if mode == 'write':
+        routing.write_manifest(routing.build_manifest(), path)
+        return
+    routing.manifest_path = path if mode != 'discover' else path + '.missing'
+    started = time.time()
+    routing.auto_route(webapp2.Router(), lazy=mode == 'lazy')
+    print time.time() - started
+
+
+def run(mode, path):
+    output = subprocess.check_output([sys.executable, __file__, mode, path])
+    return float(output.split()[-1])
+
+
+def main(runs=5):
+    path = os.path.join(tempfile.mkdtemp(), 'route_manifest.json')
+    subprocess.check_call([sys.executable, __file__, 'write', path])
+    for label, mode in modes:
+        seconds = min(run(mode, path) for _ in xrange(runs))
+        print '%-18s %8.1f ms' % (label, seconds * 1e3)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and not sys.argv[1].isdigit():
+        start(*sys.argv[1:])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares matching requests with ``webapp2.Router`` and ``routing.TrieRouter`` over the routes
+of the application's controllers. Requests are built from every route template plus paths
+no route matches, and both routers must give the same result for each of them. Run it from
+the application root with the App Engine SDK on the path::
+
+    python argeweb/core/benchmarks/router_match.py [iterations]
+
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+os.environ.setdefault('SERVER_NAME', 'localhost')
+os.environ.setdefault('SERVER_SOFTWARE', 'Benchmark')
+os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+
+from google.appengine.ext import testbed
+
+bed = testbed.Testbed()
+bed.activate()
+bed.init_memcache_stub()
+bed.init_datastore_v3_stub()
+
+import webapp2
+from argeweb.core import controller_helper, routing
+
+
+def collect_routes():
+    collector = routing._RouteCollector()
+    for controller_path in controller_helper.get_all_controller(u''):
+        routing.route_controllers(collector, controller_path)
+    return collector.routes
+
+
+def build_paths(routers):
+    paths = []
+    for route in routers[0].match_routes:
+        template = getattr(route, 'template', None)
+        if template and template.startswith('/'):
+            paths.append(re.sub(r'<[^>]*>', '1', template))
+    return paths + [path + '/missing' for path in paths[::10]] + ['/', '/missing']
+
+
+def match(router, request):
+    try:
+        route, args, kwargs = router.match(request)
+        return route.name, route.handler_method, args, kwargs
+    except webapp2.exc.HTTPException as e:
+        return type(e).__name__
+
+
+def main(iterations=20):
+    routes = collect_routes()
+    routers = (webapp2.Router(), routing.TrieRouter())
+    for router in routers:
+        for route in routes:
+            router.add(route)
+    requests = [webapp2.Request.blank(path) for path in build_paths(routers)]
+    for request in requests:
+        expected, found = match(routers[0], request), match(routers[1], request)
+        if expected != found:
+            raise AssertionError('%s matched %r instead of %r' % (request.path, found, expected))
+    print '%d routes, %d requests' % (len(routers[0].match_routes), len(requests))
+    for router in routers:
+        seconds = min(timeit.repeat(
+            lambda: [match(router, request) for request in requests], repeat=3, number=iterations))
+        print '%-12s %8.1f us per request' % (type(router).__name__, seconds / iterations / len(requests) * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -1,18 +1,659 @@
 # -*- coding: utf-8 -*-
 from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from functools import wraps
 import cPickle as pickle
+import collections
 import datetime
+import hashlib
+import json
 import logging
+import marshal
+import math
+import random
 import threading
 import inspect
+import time
+import zlib
+
+try:
+    from time import monotonic as _clock
+except ImportError:
+    # Python 2.7 has no monotonic clock (and the sandbox has no ctypes to reach one), this
+    # is time.time, so wall-clock adjustments shift in-memory expirations.
+    from timeit import default_timer as _clock
 
 
 none_sentinel_string = u'☃☸☃ - caching sentinel'
 
+#: Wraps a cached value with the time it took to compute (``delta``, in seconds) and the
+#: wall-clock time until which it is considered fresh. Only stored when early refresh or
+#: stale-while-revalidate is enabled, plain values are stored otherwise.
+CacheEntry = collections.namedtuple('CacheEntry', ['data', 'delta', 'fresh_until'])
+
+#: Keys longer than this are hashed, leaving room below memcache's 250 byte limit for the
+#: prefixes and suffixes added by leases and chunked backends.
+max_key_length = 200
+
+#: Every tagged entry also depends on this tag, see :func:`invalidate_namespace`.
+namespace_tag = '__namespace__'
+
+_policies = {}
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _resolve_backend(backend):
+    if backend is None or backend == 'memcache':
+        return MemcacheBackend
+    elif backend == 'local':
+        return LocalBackend
+    elif backend == 'datastore':
+        return DatastoreBackend
+    return backend
+
+
+def _canonical(value):
+    """
+    Returns a string for value that doesn't depend on dict ordering or object identity.
+    """
+    if isinstance(value, ndb.Key):
+        return 'Key(%s)' % value.urlsafe()
+    if isinstance(value, ndb.Model) and value.key is not None:
+        return 'Key(%s)' % value.key.urlsafe()
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return repr(value.encode('utf-8'))
+    if isinstance(value, dict):
+        return '{%s}' % ','.join('%s=%s' % item for item in sorted(
+            (_canonical(k), _canonical(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_canonical(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ','.join(sorted(_canonical(v) for v in value))
+    return repr(value)
+
+
+def build_cache_key(key, args=(), kwargs=None, key_func=None):
+    """
+    Builds the cache key used by :func:`cache_by_args`. Arguments are canonicalised
+    (keyword arguments sorted, ``ndb.Key`` and models as urlsafe keys, dates as ISO format)
+    and keys longer than ``max_key_length`` are replaced by a SHA-1 of the arguments.
+    ``key_func``, if given, is called with the arguments and its result is used instead.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    if key_func is not None:
+        suffix = key_func(*args, **(kwargs or {}))
+        suffix = suffix.encode('utf-8') if isinstance(suffix, unicode) else str(suffix)
+    else:
+        suffix = '%s:%s' % (_canonical(args), _canonical(kwargs or {}))
+    full_key = '%s:%s' % (key, suffix)
+    if len(full_key) > max_key_length:
+        return '%s:%s' % (key, hashlib.sha1(suffix).hexdigest())
+    return full_key
+
+
+def _tag_key(tag):
+    return 'cache.tag:%s' % tag
+
+
+def _initial_generation():
+    # Counters start from the clock so one that was evicted never restarts at a
+    # generation that older entries were stored under.
+    return int(time.time() * 1000)
+
+
+def get_tag_versions(tags, namespace=None):
+    """
+    Returns a dict of the current generation of each tag, creating missing counters.
+    Counters live in memcache in the current (or given) namespace, so tags are per host.
+    """
+    keys = dict((_tag_key(tag), tag) for tag in tags)
+    found = memcache.get_multi(keys.keys(), namespace=namespace)
+    missing = [k for k in keys if k not in found]
+    if missing:
+        memcache.add_multi(dict((k, _initial_generation()) for k in missing), namespace=namespace)
+        found.update(memcache.get_multi(missing, namespace=namespace))
+    return dict((keys[k], v) for k, v in found.iteritems())
+
+
+@ndb.tasklet
+def get_tag_versions_async(tags):
+    """
+    Tasklet version of :func:`get_tag_versions`, lookups are batched by ndb.
+    """
+    ctx = ndb.get_context()
+    tags = list(tags)
+    values = yield [ctx.memcache_get(_tag_key(tag)) for tag in tags]
+    versions = dict((tag, value) for tag, value in zip(tags, values) if value is not None)
+    missing = [tag for tag in tags if tag not in versions]
+    if missing:
+        yield [ctx.memcache_add(_tag_key(tag), _initial_generation()) for tag in missing]
+        values = yield [ctx.memcache_get(_tag_key(tag)) for tag in missing]
+        versions.update((tag, value) for tag, value in zip(missing, values) if value is not None)
+    raise ndb.Return(versions)
+
+
+def invalidate_tag(*tags, **kwargs):
+    """
+    Logically drops every cached entry carrying any of the tags by bumping their
+    generation, without enumerating keys. Pass ``namespace`` to target another host.
+
+    Example::
+
+        @cache('product_menu', ttl=3600, tags=['ProductModel', 'ProductCategoryModel'])
+        def product_menu():
+            ...
+
+        invalidate_tag('ProductModel')
+
+    """
+    memcache.offset_multi(dict((_tag_key(tag), 1) for tag in tags),
+                          namespace=kwargs.get('namespace'), initial_value=_initial_generation())
+
+
+def invalidate_namespace(namespace=None):
+    """
+    Drops every tagged entry of the current (or given) namespace.
+    """
+    invalidate_tag(namespace_tag, namespace=namespace)
+
+
+def _versioned_key(key, tags, versions):
+    suffix = '.'.join(str(versions.get(tag, 0)) for tag in tags)
+    if len(suffix) > 40:
+        suffix = hashlib.sha1(suffix).hexdigest()
+    return '%s@%s' % (key, suffix)
+
+
+def _completed_future(result=None):
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+def _unwrap(data):
+    if isinstance(data, CacheEntry):
+        data = data.data
+    if data == none_sentinel_string:
+        return None
+    return data
+
+
+def _needs_early_refresh(entry, beta):
+    """
+    Probabilistic early expiration (XFetch): the closer an entry gets to the end of its
+    freshness, and the longer it took to compute, the more likely a caller is to refresh it.
+    """
+    if not beta:
+        return time.time() >= entry.fresh_until
+    return time.time() - entry.delta * beta * math.log(1.0 - random.random()) >= entry.fresh_until
+
+
+def _acquire_flight(key, blocking=True):
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = [threading.Lock(), 0]
+        flight[1] += 1
+    if flight[0].acquire(blocking):
+        return flight
+    _release_flight(key, flight, locked=False)
+    return None
+
+
+def _release_flight(key, flight, locked=True):
+    if locked:
+        flight[0].release()
+    with _flights_lock:
+        flight[1] -= 1
+        if flight[1] == 0 and _flights.get(key) is flight:
+            del _flights[key]
+
+
+def _acquire_lease(key, lease_ttl):
+    return memcache.add('lease:%s' % key, 1, time=lease_ttl)
+
+
+def _release_lease(key):
+    memcache.delete('lease:%s' % key)
+
+
+def _wait_for_value(backend, key, timeout, interval=0.05):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(interval)
+        data = backend.get(key)
+        if data is not None:
+            return data
+    return None
+
+
+def key_prefix(key):
+    """
+    Returns the part of a cache key stats are grouped by, i.e. the name given to
+    :func:`cache` or :func:`cache_by_args` without arguments or tag generations.
+    """
+    return key.split('@', 1)[0].split(':', 1)[0]
+
+
+class CacheStats(object):
+    """
+    In-process registry of cache counters grouped by :func:`key_prefix`: hits, misses,
+    sets, bytes stored, seconds spent recomputing values and evictions. Counters add up
+    for the life of the instance and what changed is flushed every ``flush_interval``
+    seconds, to a log line or to :class:`CacheStatsModel` when ``sink`` is ``'datastore'``.
+    Only :class:`MemoryBackend` reports evictions, memcache evicts silently. Only strings
+    are counted in ``bytes`` unless ``measure_bytes`` is set, which pickles every other
+    value a second time on each set.
+
+    Example::
+
+        cache_stats.sink = 'datastore'
+        cache_stats.top(10, order_by='recompute_time')
+
+    """
+    fields = ('hits', 'misses', 'sets', 'bytes', 'recompute_time', 'evictions')
+
+    def __init__(self, flush_interval=300, sink='log', measure_bytes=False, enabled=True):
+        if sink not in ('log', 'datastore', None):
+            raise ValueError('Unknown stats sink %s' % sink)
+        self.flush_interval = flush_interval
+        self.sink = sink
+        self.measure_bytes = measure_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.flushed = {}
+        self.last_flush = _clock()
+
+    def record(self, prefix, **counts):
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = self.counters.get(prefix)
+            if counters is None:
+                counters = self.counters[prefix] = dict.fromkeys(self.fields, 0)
+            for field, count in counts.iteritems():
+                counters[field] += count
+            due = self.flush_interval and _clock() - self.last_flush >= self.flush_interval
+            if due:
+                self.last_flush = _clock()
+        if due:
+            self.flush()
+
+    def sizeof(self, data):
+        """
+        Size of a value as stored, only pickled when ``measure_bytes`` is set.
+        """
+        if isinstance(data, basestring):
+            return len(data)
+        if not self.measure_bytes:
+            return 0
+        try:
+            return len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError):
+            return 0
+
+    def snapshot(self):
+        with self.lock:
+            return dict((prefix, dict(counters)) for prefix, counters in self.counters.iteritems())
+
+    def top(self, limit=10, order_by='misses'):
+        """
+        Returns the ``limit`` prefixes with the highest ``order_by`` counter, each as a dict
+        of its counters along with ``prefix`` and ``hit_ratio``.
+        """
+        if order_by not in self.fields:
+            raise ValueError('Unknown cache counter %s' % order_by)
+        rows = []
+        for prefix, counters in self.snapshot().iteritems():
+            lookups = counters['hits'] + counters['misses']
+            counters['prefix'] = prefix
+            counters['hit_ratio'] = float(counters['hits']) / lookups if lookups else None
+            rows.append(counters)
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:limit]
+
+    def flush(self):
+        """
+        Writes the counters that changed since the last flush to the sink and returns them.
+        """
+        with self.lock:
+            current = dict((prefix, dict(counters)) for prefix, counters in self.counters.iteritems())
+            deltas = {}
+            for prefix, counters in current.iteritems():
+                previous = self.flushed.get(prefix, {})
+                delta = dict((field, counters[field] - previous.get(field, 0)) for field in self.fields)
+                if any(delta.values()):
+                    deltas[prefix] = delta
+            self.flushed = current
+            self.last_flush = _clock()
+        if not deltas or self.sink is None:
+            return deltas
+        if self.sink == 'datastore':
+            try:
+                CacheStatsModel.accumulate(deltas)
+            except Exception:
+                logging.exception('Unable to store cache stats')
+        else:
+            logging.info('cache stats: %s' % '; '.join(
+                '%s hits=%d misses=%d sets=%d bytes=%d recompute=%.3fs evictions=%d' % (
+                    prefix, d['hits'], d['misses'], d['sets'], d['bytes'], d['recompute_time'], d['evictions'])
+                for prefix, d in sorted(deltas.iteritems())))
+        return deltas
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.flushed = {}
+            self.last_flush = _clock()
+
+
+#: The registry every policy and :class:`MemoryBackend` reports to.
+cache_stats = CacheStats()
+
+
+def stats_action(controller, limit=20):
+    """
+    Controller action rendering the cache prefixes with the most misses (or the counter
+    given by the ``order_by`` parameter) as json. Route it from an admin controller::
+
+        @route
+        def admin_cache_stats(self):
+            return caching.stats_action(self)
+
+    """
+    order_by = controller.params.get_string('order_by', 'misses')
+    if order_by not in CacheStats.fields:
+        order_by = 'misses'
+    limit = controller.params.get_integer('limit', limit) or limit
+    controller.json({
+        'order_by': order_by,
+        'top': cache_stats.top(limit, order_by=order_by),
+        'local': LocalBackend.stats(),
+    })
+
+
+class CachePolicy(object):
+    """
+    Holds how the values of one cached function are stored and refreshed, and performs
+    the lookups for :func:`cache` and :func:`cache_by_args`. Policies are registered by
+    name so deferred revalidation tasks can find them again.
+    """
+    def __init__(self, name, f, ttl=0, backend=None, single_flight=False, lease_ttl=0, beta=0,
+                 soft_ttl=0, revalidate='deferred', tags=None):
+        if revalidate not in ('thread', 'deferred'):
+            raise ValueError('Unknown revalidate mode %s' % revalidate)
+        self.name = name
+        self.f = f
+        self.ttl = ttl
+        self.backend = _resolve_backend(backend)
+        self.single_flight = single_flight or bool(lease_ttl)
+        self.lease_ttl = lease_ttl
+        self.beta = beta
+        self.soft_ttl = soft_ttl
+        self.revalidate = revalidate
+        # Cleared once the arguments (e.g. self of a cached method) turn out unpicklable.
+        self.deferrable = True
+        self.tags = tags or ()
+        self.stats_prefix = key_prefix(name)
+        _policies[name] = self
+
+    def resolve_tags(self, args, kwargs):
+        """
+        Tags may be strings or callables taking the function's arguments.
+        """
+        tags = [namespace_tag]
+        for tag in self.tags:
+            tags.append(tag(*args, **kwargs) if callable(tag) else tag)
+        return tags
+
+    def versioned_key(self, key, args, kwargs):
+        """
+        Appends the generation of every tag to the key, so bumping any of them makes
+        lookups miss the entries stored before.
+        """
+        if not self.tags:
+            return key
+        tags = self.resolve_tags(args, kwargs)
+        return _versioned_key(key, tags, get_tag_versions(tags))
+
+    @ndb.tasklet
+    def versioned_key_async(self, key, args, kwargs):
+        if not self.tags:
+            raise ndb.Return(key)
+        tags = self.resolve_tags(args, kwargs)
+        versions = yield get_tag_versions_async(tags)
+        raise ndb.Return(_versioned_key(key, tags, versions))
+
+    def get(self, key, args, kwargs):
+        key = self.versioned_key(key, args, kwargs)
+        data = self.backend.get(key)
+        stale = None
+
+        if isinstance(data, CacheEntry):
+            if not _needs_early_refresh(data, self.beta):
+                cache_stats.record(self.stats_prefix, hits=1)
+                return _unwrap(data)
+            if self.soft_ttl:
+                cache_stats.record(self.stats_prefix, hits=1)
+                self.schedule_refresh(key, args, kwargs)
+                return _unwrap(data)
+            stale = data
+        elif data is not None:
+            cache_stats.record(self.stats_prefix, hits=1)
+            return _unwrap(data)
+
+        cache_stats.record(self.stats_prefix, misses=1)
+        if self.single_flight:
+            return self.refresh_single_flight(key, args, kwargs, stale)
+        return self.refresh(key, args, kwargs)
+
+    def cached(self, key, args=(), kwargs=None):
+        data = self.backend.get(self.versioned_key(key, args, kwargs or {}))
+        if data is None:
+            return None
+        return _unwrap(data)
+
+    def delete(self, key, args=(), kwargs=None):
+        self.backend.delete(self.versioned_key(key, args, kwargs or {}))
+
+    def get_multi(self, calls):
+        """
+        Resolves a list of ``(key, args, kwargs)`` calls with one backend round trip for the
+        lookups and one for storing whatever had to be computed.
+        """
+        if self.tags:
+            call_tags = [self.resolve_tags(args, kwargs) for key, args, kwargs in calls]
+            versions = get_tag_versions(set(tag for tags in call_tags for tag in tags))
+            calls = [(_versioned_key(key, tags, versions), args, kwargs)
+                     for (key, args, kwargs), tags in zip(calls, call_tags)]
+        found = self.backend.get_multi(list(set(call[0] for call in calls)))
+        computed = {}
+        results = []
+        for key, args, kwargs in calls:
+            data = found.get(key)
+            if isinstance(data, CacheEntry) and _needs_early_refresh(data, self.beta):
+                if self.soft_ttl:
+                    self.schedule_refresh(key, args, kwargs)
+                else:
+                    data = None
+            if data is None:
+                if key not in computed:
+                    computed[key] = self.compute(args, kwargs)
+                data = computed[key][1]
+            results.append(_unwrap(data))
+        cache_stats.record(self.stats_prefix, hits=len(calls) - len(computed), misses=len(computed))
+        if computed:
+            values = dict((k, v[1]) for k, v in computed.iteritems())
+            self.backend.set_multi(values, self.ttl)
+            self.record_sets(values.values())
+        return results
+
+    def compute(self, args, kwargs):
+        """
+        Calls the function, returns its result and the value to store in the backend.
+        """
+        started = time.time()
+        data = self.f(*args, **kwargs)
+        if isinstance(data, ndb.Future):
+            data = data.get_result()
+        cache_stats.record(self.stats_prefix, recompute_time=time.time() - started)
+        return data, self.entry_for(data, started)
+
+    def record_sets(self, values):
+        cache_stats.record(self.stats_prefix, sets=len(values),
+                           bytes=sum(cache_stats.sizeof(value) for value in values))
+
+    def entry_for(self, data, started):
+        value = none_sentinel_string if data is None else data
+        fresh_for = self.soft_ttl or self.ttl
+        if self.soft_ttl or (self.beta and self.ttl):
+            value = CacheEntry(value, time.time() - started, time.time() + fresh_for)
+        return value
+
+    @ndb.tasklet
+    def get_async(self, key, args, kwargs):
+        """
+        Tasklet version of :meth:`get`, the function may return a value or a future.
+        """
+        key = yield self.versioned_key_async(key, args, kwargs)
+        data = yield self.backend.get_async(key)
+
+        if isinstance(data, CacheEntry):
+            if not _needs_early_refresh(data, self.beta):
+                cache_stats.record(self.stats_prefix, hits=1)
+                raise ndb.Return(_unwrap(data))
+            if self.soft_ttl:
+                cache_stats.record(self.stats_prefix, hits=1)
+                self.schedule_refresh(key, args, kwargs)
+                raise ndb.Return(_unwrap(data))
+        elif data is not None:
+            cache_stats.record(self.stats_prefix, hits=1)
+            raise ndb.Return(_unwrap(data))
+
+        cache_stats.record(self.stats_prefix, misses=1)
+        started = time.time()
+        data = self.f(*args, **kwargs)
+        if isinstance(data, ndb.Future):
+            data = yield data
+        cache_stats.record(self.stats_prefix, recompute_time=time.time() - started)
+        value = self.entry_for(data, started)
+        yield self.backend.set_async(key, value, self.ttl)
+        self.record_sets([value])
+        raise ndb.Return(data)
+
+    def refresh(self, key, args, kwargs):
+        data, value = self.compute(args, kwargs)
+        self.backend.set(key, value, self.ttl)
+        self.record_sets([value])
+        return data
+
+    def refresh_single_flight(self, key, args, kwargs, stale):
+        """
+        Lets only one caller per key recompute the value. When a stale value is available
+        the other callers get it immediately, otherwise they wait for the one doing the work.
+        """
+        flight = _acquire_flight(key, blocking=stale is None)
+        if flight is None:
+            return _unwrap(stale)
+        try:
+            if stale is None:
+                # Another thread may have filled the cache while this one waited.
+                data = self.backend.get(key)
+                if data is not None and not (isinstance(data, CacheEntry) and
+                                             _needs_early_refresh(data, 0)):
+                    return _unwrap(data)
+
+            if self.lease_ttl:
+                if not _acquire_lease(key, self.lease_ttl):
+                    if stale is not None:
+                        return _unwrap(stale)
+                    data = _wait_for_value(self.backend, key, self.lease_ttl)
+                    if data is not None:
+                        return _unwrap(data)
+                    logging.info('Lease on cache key %s was not released in time, recomputing' % key)
+                    return self.refresh(key, args, kwargs)
+                try:
+                    return self.refresh(key, args, kwargs)
+                finally:
+                    _release_lease(key)
+            return self.refresh(key, args, kwargs)
+        finally:
+            _release_flight(key, flight)
+
+    def schedule_refresh(self, key, args, kwargs):
+        """
+        Recomputes a stale value off the request path, either in a background thread or in
+        a deferred task. Only one refresh per key is scheduled at a time. Values that can't
+        be refreshed in a deferred task are refreshed in a thread.
+        """
+        namespace = namespace_manager.get_namespace()
+        if self.revalidate == 'deferred' and self.deferrable:
+            if not _acquire_lease('revalidate:%s' % key, self.lease_ttl or 60):
+                return
+            from google.appengine.ext import deferred
+            try:
+                deferred.defer(_revalidate, self.f.__module__, self.name, key, args, kwargs, namespace)
+                return
+            except Exception as e:
+                if not _picklable((args, kwargs)):
+                    logging.warning('Arguments of %s cannot be pickled, refreshing it in threads: %s' % (self.name, e))
+                    self.deferrable = False
+                else:
+                    logging.warning('Unable to defer the refresh of cache key %s, using a thread: %s' % (key, e))
+                _release_lease('revalidate:%s' % key)
+
+        flight = _acquire_flight(key, blocking=False)
+        if flight is None:
+            return
+
+        def run():
+            namespace_manager.set_namespace(namespace)
+            try:
+                self.refresh(key, args, kwargs)
+            except Exception:
+                logging.exception('Background refresh of cache key %s failed' % key)
+            finally:
+                _release_flight(key, flight)
 
-def cache(key, ttl=0, backend=None):
+        thread = threading.Thread(target=run, name='cache-refresh:%s' % key)
+        thread.daemon = True
+        thread.start()
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return True
+    except Exception:
+        return False
+
+
+def _revalidate(module_name, name, key, args, kwargs, namespace):
+    """
+    Deferred task that recomputes a stale value for the policy registered under ``name``.
+    """
+    if name not in _policies:
+        __import__(module_name)
+    policy = _policies.get(name)
+    if policy is None:
+        logging.warning('No cache policy %s found in %s, unable to refresh %s' % (name, module_name, key))
+        return
+    namespace_manager.set_namespace(namespace)
+    try:
+        policy.refresh(key, args, kwargs)
+    finally:
+        _release_lease('revalidate:%s' % key)
+
+
+def cache(key, ttl=0, backend=None, single_flight=False, lease_ttl=0, beta=0, soft_ttl=0, revalidate='deferred',
+          tags=None):
     """
     General-purpose caching decorator. This decorator causes the result of a function
     to be cached so that subsequent calls will return the cached result instead of
@@ -20,7 +661,32 @@ def cache(key, ttl=0, backend=None):
     once the cache is invalid the function will be called to generate a new value and the
     cache will be refreshed. The backend argument can be used to determine how the value
     is cached- by default, the value is stored in memcache but there are built-in backends
-    for thread-local caching and caching via the datastore.
+    for instance-local caching and caching via the datastore.
+
+    Stampede protection for hot keys:
+
+    :param single_flight: Only one caller per key on this instance recomputes the value,
+        concurrent callers wait for it (or get the stale value during an early refresh).
+    :param lease_ttl: Also takes a memcache ``add()`` lease for this many seconds so only
+        one instance recomputes. Implies ``single_flight``.
+    :param beta: Enables probabilistic early expiration, values around 1.0 spread
+        refreshes out before the ttl is reached. Larger values refresh earlier.
+
+    Stale-while-revalidate:
+
+    :param soft_ttl: After this many seconds the value is stale, it's still returned
+        immediately but recomputed off the request path. ``ttl`` becomes the hard limit
+        after which callers have to wait for a new value.
+    :param revalidate: ``'deferred'`` to recompute in a deferred task, or ``'thread'`` to
+        recompute in a background thread. The standard Python 2.7 runtime waits for request
+        threads before finishing the request, so ``'thread'`` only helps outside of it.
+        Functions whose arguments can't be pickled, like methods, fall back to ``'thread'``.
+
+    Invalidation:
+
+    :param tags: Tags (strings, or callables taking the function's arguments) the value
+        depends on, :func:`invalidate_tag` drops every entry carrying a tag at once. With
+        callable tags, pass the same arguments to ``clear_cache()`` and ``cached()``.
 
     Example::
 
@@ -28,72 +694,183 @@ def cache(key, ttl=0, backend=None):
         def expensive_function():
             ...
 
-    """
-    if backend is None or backend == 'memcache':
-        backend = MemcacheBackend
-    elif backend == 'local':
-        backend = LocalBackend
-    elif backend == 'datastore':
-        backend = DatastoreBackend
+        @cache('front_page', ttl=600, single_flight=True, lease_ttl=10, beta=1.0)
+        def front_page():
+            ...
+
+        @cache('sidebar', ttl=86400, soft_ttl=300, revalidate='deferred')
+        def sidebar():
+            ...
 
+    """
     def wrapper(f):
+        policy = CachePolicy(key, f, ttl, backend, single_flight=single_flight, lease_ttl=lease_ttl,
+                             beta=beta, soft_ttl=soft_ttl, revalidate=revalidate, tags=tags)
+
         @wraps(f)
         def dispatcher(*args, **kwargs):
-            data = backend.get(key)
+            return policy.get(key, args, kwargs)
 
-            if data == none_sentinel_string:
-                return None
+        setattr(dispatcher, 'clear_cache', lambda *args, **kwargs: policy.delete(key, args, kwargs))
+        setattr(dispatcher, 'cached', lambda *args, **kwargs: policy.cached(key, args, kwargs))
+        setattr(dispatcher, 'uncached', f)
+        return dispatcher
+    return wrapper
 
-            if data is None:
-                data = f(*args, **kwargs)
-                backend.set(key, none_sentinel_string if data is None else data, ttl)
 
-            return data
+def _cache_key_builder(key, f, key_func=None):
+    argspec = inspect.getargspec(f)[0]
 
-        def cache_getter():
-            data = backend.get(key)
-            if data == none_sentinel_string:
-                return None
-            return data
+    if len(argspec) and argspec[0] in ('self', 'cls'):
+        is_method = True
+    else:
+        is_method = False
+
+    def cache_key(*args, **kwargs):
+        targs = args if not is_method else args[1:]
+        return build_cache_key(key, targs, kwargs, key_func)
+    return cache_key
+
+
+def cache_by_args(key, ttl=0, backend=None, single_flight=False, lease_ttl=0, beta=0, soft_ttl=0,
+                  revalidate='deferred', key_func=None, tags=None):
+    """
+    Like :func:`cache`, but will use any arguments to the function as part of the key to
+    ensure that variadic functions are cached separately. Keys are built by
+    :func:`build_cache_key`, arguments other than plain data types, dates, ``ndb.Key`` and
+    models fall back to their ``repr``. Pass ``key_func`` to build the argument part of the
+    key yourself, it receives the same arguments as the function (without ``self``/``cls``).
+
+    Example::
 
-        setattr(dispatcher, 'clear_cache', lambda: backend.delete(key))
-        setattr(dispatcher, 'cached', cache_getter)
+        @cache_by_args('product_list', ttl=600, key_func=lambda category, page=1: '%s:%s' % (category.id(), page))
+        def product_list(category, page=1):
+            ...
+
+    """
+    def wrapper(f):
+        policy = CachePolicy(key, f, ttl, backend, single_flight=single_flight, lease_ttl=lease_ttl,
+                             beta=beta, soft_ttl=soft_ttl, revalidate=revalidate, tags=tags)
+        cache_key = _cache_key_builder(key, f, key_func)
+
+        @wraps(f)
+        def dispatcher(*args, **kwargs):
+            return policy.get(cache_key(*args, **kwargs), args, kwargs)
+
+        setattr(dispatcher, 'cache_key', cache_key)
+        setattr(dispatcher, 'cache_policy', policy)
         setattr(dispatcher, 'uncached', f)
         return dispatcher
     return wrapper
 
 
-def cache_by_args(key, ttl=0, backend=None):
+def cache_async(key, ttl=0, backend=None, beta=0, soft_ttl=0, revalidate='deferred', tags=None):
     """
-    Like :func:`cache`, but will use any arguments to the function as part of the key to
-    ensure that variadic functions are cached separately. Argument must be able to be
-    printed as a string- it's recommended to use plain data types as arguments.
+    Like :func:`cache`, but the decorated function returns an ``ndb.Future`` so several
+    lookups can run in parallel. The function itself may be a tasklet or a plain function.
+    Memcache lookups issued in the same event loop are batched together by ndb.
+    Single-flight isn't available here since waiting on a lock would stall the event loop.
+
+    Example::
+
+        @cache_async('sidebar', ttl=600)
+        @ndb.tasklet
+        def sidebar():
+            posts = yield Post.query().fetch_async(10)
+            raise ndb.Return(render_sidebar(posts))
+
+        sidebar_future, footer_future = sidebar(), footer()
+        sidebar_html, footer_html = sidebar_future.get_result(), footer_future.get_result()
+
     """
     def wrapper(f):
-        argspec = inspect.getargspec(f)[0]
-
-        if len(argspec) and argspec[0] in ('self', 'cls'):
-            is_method = True
-        else:
-            is_method = False
+        policy = CachePolicy(key, f, ttl, backend, beta=beta, soft_ttl=soft_ttl, revalidate=revalidate, tags=tags)
 
         @wraps(f)
         def dispatcher(*args, **kwargs):
-            targs = args if not is_method else args[1:]
-            arg_key = '%s:%s:%s' % (key, targs, kwargs)
+            return policy.get_async(key, args, kwargs)
+
+        setattr(dispatcher, 'clear_cache', lambda *args, **kwargs: policy.delete(key, args, kwargs))
+        setattr(dispatcher, 'cached', lambda *args, **kwargs: policy.cached(key, args, kwargs))
+        setattr(dispatcher, 'uncached', f)
+        return dispatcher
+    return wrapper
 
-            @cache(arg_key, ttl, backend=backend)
-            def inner_dispatcher():
-                return f(*args, **kwargs)
 
-            return inner_dispatcher()
+def cache_by_args_async(key, ttl=0, backend=None, beta=0, soft_ttl=0, revalidate='deferred', key_func=None,
+                        tags=None):
+    """
+    Like :func:`cache_by_args`, but returns an ``ndb.Future``. See :func:`cache_async`.
+    """
+    def wrapper(f):
+        policy = CachePolicy(key, f, ttl, backend, beta=beta, soft_ttl=soft_ttl, revalidate=revalidate, tags=tags)
+        cache_key = _cache_key_builder(key, f, key_func)
+
+        @wraps(f)
+        def dispatcher(*args, **kwargs):
+            return policy.get_async(cache_key(*args, **kwargs), args, kwargs)
+
+        setattr(dispatcher, 'cache_key', cache_key)
+        setattr(dispatcher, 'cache_policy', policy)
+        setattr(dispatcher, 'uncached', f)
         return dispatcher
     return wrapper
 
 
+def cache_many(function, args_list, **kwargs):
+    """
+    Calls a function decorated with :func:`cache_by_args` once for every argument tuple
+    in ``args_list``, but looks all of them up in a single backend round trip and stores
+    the missing ones with another. Keyword arguments are passed to every call. Returns
+    the results in the same order as ``args_list``.
+
+    Example::
+
+        @cache_by_args('product_fragment', ttl=600)
+        def product_fragment(product_id, lang):
+            ...
+
+        fragments = cache_many(product_fragment, [(1, 'en'), (2, 'en'), (3, 'en')])
+
+    """
+    bound_to = getattr(function, 'im_self', None)
+    calls = []
+    for args in args_list:
+        if not isinstance(args, tuple):
+            args = (args,)
+        if bound_to is not None:
+            args = (bound_to,) + args
+        calls.append((function.cache_key(*args, **kwargs), args, kwargs))
+    return function.cache_policy.get_multi(calls)
+
+
+def get_or_set(key, f, ttl=0, backend=None, tags=None):
+    """
+    Returns the value cached under ``key``, or calls ``f`` and caches its result. For values
+    that aren't the result of a decorated function, such as template fragments. Entries
+    depend on :data:`namespace_tag` and ``tags`` like those of :func:`cache`.
+    """
+    backend = _resolve_backend(backend)
+    tags = [namespace_tag] + list(tags or ())
+    key = _versioned_key(key, tags, get_tag_versions(tags))
+    prefix = key_prefix(key)
+    data = backend.get(key)
+    if data is not None:
+        cache_stats.record(prefix, hits=1)
+        return _unwrap(data)
+
+    cache_stats.record(prefix, misses=1)
+    started = time.time()
+    data = f()
+    value = none_sentinel_string if data is None else data
+    backend.set(key, value, ttl)
+    cache_stats.record(prefix, recompute_time=time.time() - started, sets=1, bytes=cache_stats.sizeof(value))
+    return data
+
+
 def cache_using_local(key, ttl=0):
     """
-    Shortcut decorator for caching using the thread-local cache.
+    Shortcut decorator for caching using the instance-local cache.
     """
     return cache(key, ttl, backend=LocalBackend)
 
@@ -114,7 +891,7 @@ def cache_using_datastore(key, ttl=0):
 
 def cache_by_args_using_local(key, ttl=0):
     """
-    Shortcut decorator for caching by arguments using the thread-local cache.
+    Shortcut decorator for caching by arguments using the instance-local cache.
     """
     return cache_by_args(key, ttl, backend=LocalBackend)
 
@@ -133,45 +910,310 @@ def cache_by_args_using_datastore(key, ttl=0):
     return cache_by_args(key, ttl, backend=DatastoreBackend)
 
 
+#: Serializers available to the chunked backends, by name: (header tag, dumps, loads).
+#: ``json`` only takes plain types and doesn't round-trip them all: tuples come back as
+#: lists and ``str`` as ``unicode``.
+serializers = {
+    'pickle': ('p', lambda data: pickle.dumps(data, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    'marshal': ('m', marshal.dumps, marshal.loads),
+    'json': ('j', json.dumps, json.loads),
+}
+
+# Marks values written by encode_value. Legacy values are plain pickles which always start
+# with the protocol opcode '\x80', so the two can't be confused.
+_header_magic = '\x00awc'
+
+
+def register_serializer(name, tag, dumps, loads):
+    """
+    Adds a serializer that chunked backends can use with ``serializer = name``. The tag
+    is a single character stored in each value's header so it can be read back.
+    """
+    serializers[name] = (tag, dumps, loads)
+
+
+def encode_value(data, serializer='pickle', compress_threshold=None, compress_level=6):
+    """
+    Serializes data and prefixes it with a header recording the serializer and whether
+    the payload is zlib-compressed. Data the serializer can't handle (e.g. models or dates
+    with marshal or json) falls back to pickle. Payloads of at least ``compress_threshold``
+    bytes are compressed.
+    """
+    tag, dumps, loads = serializers[serializer]
+    try:
+        payload = dumps(data)
+    except (ValueError, TypeError):
+        tag, dumps, loads = serializers['pickle']
+        payload = dumps(data)
+    flag = '-'
+    if compress_threshold is not None and len(payload) >= compress_threshold:
+        payload = zlib.compress(payload, compress_level)
+        flag = 'z'
+    return _header_magic + tag + flag + payload
+
+
+def decode_value(serialized):
+    """
+    Reverses :func:`encode_value`, values written before headers existed are unpickled.
+    """
+    if not serialized.startswith(_header_magic):
+        return pickle.loads(serialized)
+    offset = len(_header_magic)
+    tag, flag = serialized[offset], serialized[offset + 1]
+    payload = serialized[offset + 2:]
+    if flag == 'z':
+        payload = zlib.decompress(payload)
+    for name, (serializer_tag, dumps, loads) in serializers.iteritems():
+        if serializer_tag == tag:
+            return loads(payload)
+    raise ValueError('Unknown cache serializer %s' % tag)
+
+
+#: Written after all of a value's chunks, so readers only ever see complete versions.
+#: Chunk keys include the version so concurrent writers never overwrite each other's chunks.
+ChunkManifest = collections.namedtuple('ChunkManifest', ['version', 'count', 'checksum'])
+
+
+def _split_chunks(key, serialized, chunksize, maxchunks):
+    len_serialized = len(serialized)
+    # create a (generator) for chunk sizes
+    chunks = xrange(0, len_serialized, chunksize)
+    if len(chunks) > maxchunks:
+        raise ValueError("Cached object %s's size %i is %i chunks, more than maximum of %i" % \
+                         (key, len_serialized, len(chunks), maxchunks))
+    manifest = ChunkManifest('%08x' % random.getrandbits(32), len(chunks),
+                             zlib.adler32(serialized) & 0xffffffff)
+    return manifest, [serialized[i:i+chunksize] for i in chunks]
+
+
+def _join_chunks(key, manifest, chunks):
+    """
+    Returns the serialized value or None if chunks are missing or don't match the checksum,
+    e.g. because some were evicted.
+    """
+    if len(chunks) != manifest.count or None in chunks:
+        logging.debug('Chunks of %s (version %s) are incomplete' % (key, manifest.version))
+        return None
+    serialized = ''.join(chunks)
+    if zlib.adler32(serialized) & 0xffffffff != manifest.checksum:
+        logging.warning('Chunks of %s (version %s) do not match their checksum' % (key, manifest.version))
+        return None
+    return serialized
+
+
+class MemoryBackend(object):
+    """
+    Process-wide in-memory cache shared by every thread of the instance. Entries are
+    evicted in LRU (or LFU) order once ``max_entries`` or ``max_bytes`` is exceeded,
+    and expire after their ttl. The ttl is measured on a monotonic clock where there is
+    one, on Python 2.7 it's the wall clock, so an adjustment of the system time can expire
+    entries early or keep them longer. Keys are scoped by the current namespace, like
+    memcache's, so hosts sharing an instance don't see each other's values.
+
+    Example::
+
+        fragments = MemoryBackend(max_entries=500, max_bytes=16 * 1024 * 1024)
+
+        @cache('something_expensive', ttl=60, backend=fragments)
+        def expensive_function():
+            ...
+
+    """
+    def __init__(self, max_entries=1000, max_bytes=None, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('Unknown eviction policy %s' % policy)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _key(key):
+        return namespace_manager.get_namespace(), key
+
+    def _sizeof(self, data):
+        if not self.max_bytes:
+            return 0
+        if isinstance(data, basestring):
+            return len(data)
+        try:
+            return len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError):
+            return 0
+
+    def _remove(self, key):
+        data, expires, size, count = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def _evict(self, inserted=None):
+        evicted = []
+        while self.entries and (
+                (self.max_entries and len(self.entries) > self.max_entries) or
+                (self.max_bytes and self.current_bytes > self.max_bytes)):
+            if self.policy == 'lfu':
+                # The least used entry, oldest first when counts are equal. The entry just
+                # inserted was never read, it would always lose.
+                candidates = [k for k in self.entries if k != inserted] or [inserted]
+                key = min(candidates, key=lambda k: self.entries[k][3])
+            else:
+                key = next(iter(self.entries))
+            self._remove(key)
+            self.evictions += 1
+            evicted.append(key)
+        return evicted
+
+    def set(self, key, data, ttl):
+        expires = _clock() + ttl if ttl else None
+        size = self._sizeof(data)
+        if self.max_bytes and size > self.max_bytes:
+            # Would evict everything else and still not fit.
+            self.delete(key)
+            return
+        key = self._key(key)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (data, expires, size, 0)
+            self.current_bytes += size
+            evicted = self._evict(key)
+        # Reported outside the lock, recording may flush the stats.
+        for namespace, key in evicted:
+            cache_stats.record(key_prefix(key), evictions=1)
+
+    def get(self, key):
+        key = self._key(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            data, expires, size, count = entry
+            if expires and expires < _clock():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            del self.entries[key]
+            self.entries[key] = (data, expires, size, count + 1)
+            self.hits += 1
+            return data
+
+    def delete(self, key):
+        key = self._key(key)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def get_async(self, key):
+        return _completed_future(self.get(key))
+
+    def set_async(self, key, data, ttl):
+        return _completed_future(self.set(key, data, ttl))
+
+    def delete_async(self, key):
+        return _completed_future(self.delete(key))
+
+    def get_multi(self, keys):
+        result = {}
+        for key in keys:
+            data = self.get(key)
+            if data is not None:
+                result[key] = data
+        return result
+
+    def set_multi(self, mapping, ttl):
+        for key, data in mapping.iteritems():
+            self.set(key, data, ttl)
+
+    def delete_multi(self, keys):
+        with self.lock:
+            for key in map(self._key, keys):
+                if key in self.entries:
+                    self._remove(key)
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counters along with the current size.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
 class LocalBackend(object):
     """
-    The local backend stores caches in a thread-local variable. The caches are available
-    for this thread and likely just for the duration of one request.
+    The local backend stores caches in a bounded, process-wide :class:`MemoryBackend`.
+    The caches are shared by every thread of this instance and live until they expire
+    or are evicted. Use :meth:`configure` at startup to change the limits.
     """
-    cache_obj = threading.local()
+    cache_obj = MemoryBackend()
+
+    @classmethod
+    def configure(cls, max_entries=1000, max_bytes=None, policy='lru'):
+        cls.cache_obj = MemoryBackend(max_entries=max_entries, max_bytes=max_bytes, policy=policy)
 
     @classmethod
     def set(cls, key, data, ttl):
-        if ttl:
-            expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
-        else:
-            expires = None
-        setattr(cls.cache_obj, key, (data, expires))
+        cls.cache_obj.set(key, data, ttl)
 
     @classmethod
     def get(cls, key):
-        if not hasattr(cls.cache_obj, key):
-            return None
+        return cls.cache_obj.get(key)
 
-        data, expires = getattr(cls.cache_obj, key)
+    @classmethod
+    def delete(cls, key):
+        cls.cache_obj.delete(key)
 
-        if expires and expires < datetime.datetime.now():
-            delattr(cls.cache_obj, key)
-            return None
+    @classmethod
+    def get_async(cls, key):
+        return cls.cache_obj.get_async(key)
 
-        return data
+    @classmethod
+    def set_async(cls, key, data, ttl):
+        return cls.cache_obj.set_async(key, data, ttl)
 
     @classmethod
-    def delete(cls, key):
-        try:
-            delattr(cls.cache_obj, key)
-        except AttributeError:
-            pass
+    def delete_async(cls, key):
+        return cls.cache_obj.delete_async(key)
+
+    @classmethod
+    def get_multi(cls, keys):
+        return cls.cache_obj.get_multi(keys)
+
+    @classmethod
+    def set_multi(cls, mapping, ttl):
+        cls.cache_obj.set_multi(mapping, ttl)
+
+    @classmethod
+    def delete_multi(cls, keys):
+        cls.cache_obj.delete_multi(keys)
 
     @classmethod
     def reset(cls):
-        for a in cls.cache_obj.__dict__.keys():
-            delattr(cls.cache_obj, a)
+        cls.cache_obj.reset()
+
+    @classmethod
+    def stats(cls):
+        return cls.cache_obj.stats()
 
 
 class MemcacheBackend(object):
@@ -191,48 +1233,210 @@ class MemcacheBackend(object):
     def delete(cls, key):
         memcache.delete(key)
 
+    @classmethod
+    def get_async(cls, key):
+        return ndb.get_context().memcache_get(key)
+
+    @classmethod
+    def set_async(cls, key, data, ttl):
+        return ndb.get_context().memcache_set(key, data, time=(ttl or 0))
+
+    @classmethod
+    def delete_async(cls, key):
+        return ndb.get_context().memcache_delete(key)
+
+    @classmethod
+    def get_multi(cls, keys):
+        return memcache.get_multi(keys)
+
+    @classmethod
+    def set_multi(cls, mapping, ttl):
+        memcache.set_multi(mapping, time=(ttl or 0))
+
+    @classmethod
+    def delete_multi(cls, keys):
+        memcache.delete_multi(keys)
+
 
 class MemcacheChunkedBackend(MemcacheBackend):
     """
     Stores cache in memcache as multiple chunks if needed.  Chunking code informed from
-    `flask-cache` repository by Thadeus Burgess.
+    `flask-cache` repository by Thadeus Burgess. Values are serialized with
+    :func:`encode_value`, large ones are compressed before being chunked. The chunks are
+    written first and a :class:`ChunkManifest` last, reads fetch exactly the chunks the
+    manifest lists and treat missing or mismatching chunks as a cache miss. The chunks of
+    a manifest are deleted once it has been replaced or deleted.
+
+    Example::
+
+        class FragmentBackend(MemcacheChunkedBackend):
+            serializer = 'marshal'
+            compress_threshold = 1024
+
     """
     chunksize = 1000000 # 10^6 bytes is Memcache's max.
     # 32 Megabytes is max set_multi for memcache
     maxchunks = 32 * 1024 * 1024 // chunksize
+    #: Name of the serializer in :data:`serializers`, subclass to change it.
+    serializer = 'pickle'
+    #: Values of at least this many serialized bytes are zlib-compressed, None disables it.
+    compress_threshold = 16 * 1024
 
     @classmethod
-    def set(cls, key, data, ttl):
-        """ Divides the object into multiple chunks and sets it. """
-        serialized = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
-        len_serialized = len(serialized)
-        # create a (generator) for chunk sizes
-        chunks = xrange(0, len_serialized, cls.chunksize)
-        multi_data = {}
-        if len(chunks) > cls.maxchunks:
-            raise ValueError("Cached object %s's size %i is %i chunks, more than maximum of %i" % \
-                             (key, len_serialized, len(chunks), cls.maxchunks))
+    def _chunk_keys(cls, key, manifest):
+        return ['%s.%s.%i' % (key, manifest.version, i) for i in xrange(manifest.count)]
+
+    @classmethod
+    def _chunk(cls, key, data):
+        serialized = encode_value(data, cls.serializer, cls.compress_threshold)
+        manifest, chunks = _split_chunks(key, serialized, cls.chunksize, cls.maxchunks)
+        return manifest, dict(zip(cls._chunk_keys(key, manifest), chunks))
 
-        for i in chunks:
-            multi_data['%s.%i' % (key, i//cls.chunksize)] = serialized[i:i+cls.chunksize]
-        return memcache.set_multi(multi_data, time=(ttl or 0))
+    @classmethod
+    def _unchunk(cls, key, manifest, multi_values):
+        if not isinstance(manifest, ChunkManifest):
+            return None
+        serialized = _join_chunks(key, manifest, [multi_values.get(k) for k in cls._chunk_keys(key, manifest)])
+        if serialized is None:
+            return None
+        return decode_value(serialized)
 
+    @classmethod
+    def set(cls, key, data, ttl):
+        """
+        Divides the object into multiple chunks, sets them and then the manifest with
+        compare-and-set, so the chunks deleted afterwards are the ones of the manifest it
+        replaced.
+        """
+        manifest, multi_data = cls._chunk(key, data)
+        if memcache.set_multi(multi_data, time=(ttl or 0)):
+            logging.warning('Unable to store all chunks of %s, keeping the previous value' % key)
+            return False
+        client = memcache.Client()
+        for _ in range(10):
+            previous = client.gets(key)
+            if previous is None:
+                stored = client.add(key, manifest, time=(ttl or 0))
+            else:
+                stored = client.cas(key, manifest, time=(ttl or 0))
+            if stored:
+                break
+        else:
+            logging.warning('Unable to store the manifest of %s, keeping the other value' % key)
+            memcache.delete_multi(multi_data.keys())
+            return False
+        if isinstance(previous, ChunkManifest):
+            memcache.delete_multi(cls._chunk_keys(key, previous))
+        return True
 
     @classmethod
     def get(cls, key):
-        """ Loads the keys from memcached and deserializes. """
-        multi_keys = ['%s.%i' % (key, i) for i in xrange(cls.maxchunks)]
-        multi_values = memcache.get_multi(multi_keys)
-        serialized = ''.join([multi_values[k] for k in multi_keys if k in multi_values])
-        if not serialized:
+        """ Loads the manifest and then exactly the chunks it lists. """
+        manifest = memcache.get(key)
+        if not isinstance(manifest, ChunkManifest):
             return None
-        return pickle.loads(serialized)
+        return cls._unchunk(key, manifest, memcache.get_multi(cls._chunk_keys(key, manifest)))
 
     @classmethod
     def delete(cls, key):
-        """ Deletes all the keys from memcache"""
-        multi_keys = ['%s.%i' % (key, i) for i in xrange(cls.maxchunks)]
-        memcache.delete_multi(multi_keys)
+        """ Deletes the manifest and its chunks. """
+        manifest = memcache.get(key)
+        memcache.delete(key)
+        if isinstance(manifest, ChunkManifest):
+            memcache.delete_multi(cls._chunk_keys(key, manifest))
+
+    @classmethod
+    @ndb.tasklet
+    def get_async(cls, key):
+        ctx = ndb.get_context()
+        manifest = yield ctx.memcache_get(key)
+        if not isinstance(manifest, ChunkManifest):
+            raise ndb.Return(None)
+        multi_keys = cls._chunk_keys(key, manifest)
+        values = yield [ctx.memcache_get(k) for k in multi_keys]
+        raise ndb.Return(cls._unchunk(key, manifest, dict(zip(multi_keys, values))))
+
+    @classmethod
+    @ndb.tasklet
+    def set_async(cls, key, data, ttl):
+        ctx = ndb.get_context()
+        manifest, multi_data = cls._chunk(key, data)
+        results = yield [ctx.memcache_set(k, v, time=(ttl or 0)) for k, v in multi_data.iteritems()]
+        if not all(results):
+            logging.warning('Unable to store all chunks of %s, keeping the previous value' % key)
+            raise ndb.Return(False)
+        for _ in range(10):
+            previous = yield ctx.memcache_gets(key)
+            if previous is None:
+                stored = yield ctx.memcache_add(key, manifest, time=(ttl or 0))
+            else:
+                stored = yield ctx.memcache_cas(key, manifest, time=(ttl or 0))
+            if stored:
+                break
+        else:
+            logging.warning('Unable to store the manifest of %s, keeping the other value' % key)
+            yield [ctx.memcache_delete(k) for k in multi_data]
+            raise ndb.Return(False)
+        if isinstance(previous, ChunkManifest):
+            yield [ctx.memcache_delete(k) for k in cls._chunk_keys(key, previous)]
+        raise ndb.Return(True)
+
+    @classmethod
+    @ndb.tasklet
+    def delete_async(cls, key):
+        ctx = ndb.get_context()
+        manifest = yield ctx.memcache_get(key)
+        yield ctx.memcache_delete(key)
+        if isinstance(manifest, ChunkManifest):
+            yield [ctx.memcache_delete(k) for k in cls._chunk_keys(key, manifest)]
+
+    @classmethod
+    def get_multi(cls, keys):
+        """ Loads all manifests with one get_multi and all their chunks with another. """
+        manifests = memcache.get_multi(keys)
+        multi_keys = []
+        for key, manifest in manifests.iteritems():
+            if isinstance(manifest, ChunkManifest):
+                multi_keys += cls._chunk_keys(key, manifest)
+        multi_values = memcache.get_multi(multi_keys) if multi_keys else {}
+        result = {}
+        for key, manifest in manifests.iteritems():
+            data = cls._unchunk(key, manifest, multi_values)
+            if data is not None:
+                result[key] = data
+        return result
+
+    @classmethod
+    def set_multi(cls, mapping, ttl):
+        manifests = {}
+        multi_data = {}
+        for key, data in mapping.iteritems():
+            manifests[key], chunks = cls._chunk(key, data)
+            multi_data.update(chunks)
+        failed = set(memcache.set_multi(multi_data, time=(ttl or 0)))
+        for key, manifest in manifests.items():
+            if failed.intersection(cls._chunk_keys(key, manifest)):
+                logging.warning('Unable to store all chunks of %s, keeping the previous value' % key)
+                del manifests[key]
+        previous = memcache.get_multi(manifests.keys()) if manifests else {}
+        not_set = memcache.set_multi(manifests, time=(ttl or 0))
+        cls._delete_chunks(dict((k, v) for k, v in previous.iteritems() if k not in not_set))
+        return not_set
+
+    @classmethod
+    def delete_multi(cls, keys):
+        manifests = memcache.get_multi(keys)
+        memcache.delete_multi(keys)
+        cls._delete_chunks(manifests)
+
+    @classmethod
+    def _delete_chunks(cls, manifests):
+        chunk_keys = []
+        for key, manifest in manifests.iteritems():
+            if isinstance(manifest, ChunkManifest):
+                chunk_keys += cls._chunk_keys(key, manifest)
+        if chunk_keys:
+            memcache.delete_multi(chunk_keys)
 
 
 class MemcacheCompareAndSetBackend(MemcacheBackend):
@@ -251,6 +1455,31 @@ class MemcacheCompareAndSetBackend(MemcacheBackend):
             if client.cas(key, data, ttl):
                 break
 
+    @classmethod
+    @ndb.tasklet
+    def set_async(cls, key, data, ttl):
+        ctx = ndb.get_context()
+        existing = yield ctx.memcache_gets(key)
+        if not existing:
+            yield ctx.memcache_set(key, data, time=(ttl or 0))
+            return
+
+        for _ in range(10):
+            stored = yield ctx.memcache_cas(key, data, time=(ttl or 0))
+            if stored:
+                break
+
+    @classmethod
+    def set_multi(cls, mapping, ttl):
+        client = memcache.Client()
+        existing = client.get_multi(mapping.keys(), for_cas=True)
+        new_data = dict((k, v) for k, v in mapping.iteritems() if k not in existing)
+        if new_data:
+            memcache.set_multi(new_data, time=(ttl or 0))
+        cas_data = dict((k, v) for k, v in mapping.iteritems() if k in existing)
+        if cas_data:
+            client.cas_multi(cas_data, time=(ttl or 0))
+
 
 class DatastoreBackend(object):
     """
@@ -284,67 +1513,189 @@ class DatastoreBackend(object):
     def delete(cls, key):
         ndb.Key(DatastoreCacheModel, key).delete()
 
+    @classmethod
+    @ndb.tasklet
+    def get_async(cls, key):
+        item = yield ndb.Key(DatastoreCacheModel, key).get_async()
+
+        if not item:
+            raise ndb.Return(None)
+
+        if item.expires and item.expires < datetime.datetime.now():
+            yield item.key.delete_async()
+            raise ndb.Return(None)
+
+        raise ndb.Return(item.data)
+
+    @classmethod
+    def set_async(cls, key, data, ttl):
+        if ttl:
+            expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        else:
+            expires = None
+
+        return DatastoreCacheModel(id=key, data=data, expires=expires).put_async()
+
+    @classmethod
+    def delete_async(cls, key):
+        return ndb.Key(DatastoreCacheModel, key).delete_async()
+
+    @classmethod
+    def get_multi(cls, keys):
+        items = ndb.get_multi([ndb.Key(DatastoreCacheModel, key) for key in keys])
+        now = datetime.datetime.now()
+        result = {}
+        expired = []
+        for key, item in zip(keys, items):
+            if not item:
+                continue
+            if item.expires and item.expires < now:
+                expired.append(item.key)
+                continue
+            result[key] = item.data
+        if expired:
+            ndb.delete_multi(expired)
+        return result
+
+    @classmethod
+    def set_multi(cls, mapping, ttl):
+        if ttl:
+            expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        else:
+            expires = None
+        ndb.put_multi([DatastoreCacheModel(id=key, data=data, expires=expires)
+                       for key, data in mapping.iteritems()])
+
+    @classmethod
+    def delete_multi(cls, keys):
+        ndb.delete_multi([ndb.Key(DatastoreCacheModel, key) for key in keys])
+
 
 class DatastoreChunkedBackend(object):
     """
     Stores caches in the datastore which has the effect of them being durable and persistent,
     unlike the memcache and local backends. Items stored in the datastore are certain to remain
     until the expiration time passes.  Chunks the data if it is greater than the chunksize (1MB).
+    Like :class:`MemcacheChunkedBackend` a manifest entity is written after the chunks,
+    in a transaction that returns the manifest it replaced, whose chunks are deleted
+    afterwards. Concurrent writers each delete the chunks of the version they overwrote.
     """
     chunksize = 1024 * 1024  #1MB
-    maxchunks = 20 # limit this to be close to the max obj size, to reduce number of
-                   # unnecessary queries.
+    maxchunks = 20 # limit this to be close to the max obj size
+    #: Name of the serializer in :data:`serializers`, subclass to change it.
+    serializer = 'pickle'
+    #: Values of at least this many serialized bytes are zlib-compressed, None disables it.
+    #: Off by default, :class:`DatastoreCacheModel` already compresses what it stores.
+    compress_threshold = None
 
     @classmethod
-    @ndb.toplevel
-    def set(cls, key, data, ttl):
-        """ Adds data to the Datastore, broken into as a series of chunks <= `chunksize`"""
+    def _chunk_keys(cls, key, manifest):
+        return [ndb.Key(DatastoreCacheModel, '%s.%s.%i' % (key, manifest.version, i))
+                for i in xrange(manifest.count)]
+
+    @classmethod
+    def _chunk(cls, key, data, expires):
+        serialized = encode_value(data, cls.serializer, cls.compress_threshold)
+        manifest, chunks = _split_chunks(key, serialized, cls.chunksize, cls.maxchunks)
+        entities = [DatastoreCacheModel(key=chunk_key, data=chunk, expires=expires)
+                    for chunk_key, chunk in zip(cls._chunk_keys(key, manifest), chunks)]
+        return DatastoreCacheModel(id=key, data=manifest, expires=expires), entities
+
+    @classmethod
+    def _is_expired(cls, item):
+        return item.expires and item.expires < datetime.datetime.now()
+
+    @classmethod
+    @ndb.tasklet
+    def get_async(cls, key):
+        """ Loads the key's manifest and then exactly the chunks it lists. """
+        item = yield ndb.Key(DatastoreCacheModel, key).get_async(use_memcache=False, use_cache=False)
+        if not item or not isinstance(item.data, ChunkManifest):
+            raise ndb.Return(None)
+        if cls._is_expired(item):
+            logging.info("DatastoreChunkedBackend item '%s' is expired. Returning None" % (key))
+            yield ndb.delete_multi_async([item.key] + cls._chunk_keys(key, item.data))
+            raise ndb.Return(None)
+        chunks = yield ndb.get_multi_async(cls._chunk_keys(key, item.data), use_memcache=False, use_cache=False)
+        serialized = _join_chunks(key, item.data, [chunk.data if chunk else None for chunk in chunks])
+        if serialized is None:
+            raise ndb.Return(None)
+        raise ndb.Return(decode_value(serialized))
+
+    @classmethod
+    @ndb.tasklet
+    def set_async(cls, key, data, ttl):
+        """ Writes the chunks, then the manifest, then removes the replaced version's chunks. """
         if ttl:
             expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
         else:
             expires = None
 
-        serialized = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
-        len_serialized = len(serialized)
-        # create a (generator) for chunk sizes
-        chunks = xrange(0, len_serialized, cls.chunksize)
-        multi_data = {}
-        if len(chunks) > cls.maxchunks:
-            raise ValueError("Cached object %s's size %i is %i chunks, more than maxium of %i" % \
-                             (key, len_serialized, len(chunks), cls.maxchunks))
+        manifest, entities = cls._chunk(key, data, expires)
+        yield ndb.put_multi_async(entities, use_memcache=False, use_cache=False)
 
-        for i in chunks:
-            DatastoreCacheModel(id='%s.%i' % (key, i//cls.chunksize),\
-                                data=serialized[i:i+cls.chunksize],\
-                                expires=expires).put_async()
+        @ndb.tasklet
+        def replace():
+            replaced = yield manifest.key.get_async(use_memcache=False, use_cache=False)
+            yield manifest.put_async(use_memcache=False, use_cache=False)
+            raise ndb.Return(replaced)
 
+        try:
+            previous = yield ndb.transaction_async(replace)
+        except datastore_errors.TransactionFailedError:
+            logging.warning('Unable to store cache key %s, too many concurrent writers' % key)
+            yield ndb.delete_multi_async([entity.key for entity in entities])
+            return
+        if previous and isinstance(previous.data, ChunkManifest):
+            yield ndb.delete_multi_async(cls._chunk_keys(key, previous.data))
+
+    @classmethod
+    @ndb.tasklet
+    def delete_async(cls, key):
+        """ Deletes the manifest and the chunks it lists. """
+        item = yield ndb.Key(DatastoreCacheModel, key).get_async(use_memcache=False, use_cache=False)
+        if not item:
+            return
+        keys = [item.key]
+        if isinstance(item.data, ChunkManifest):
+            keys += cls._chunk_keys(key, item.data)
+        yield ndb.delete_multi_async(keys)
+
+    @classmethod
+    def set(cls, key, data, ttl):
+        """ Adds data to the Datastore, broken into as a series of chunks <= `chunksize`"""
+        cls.set_async(key, data, ttl).get_result()
 
     @classmethod
     def get(cls, key):
         """ Loads the key's chunks from Datastore and reassembles them. """
-        multi_keys = [ndb.Key(DatastoreCacheModel, '%s.%i' % (key, i)) for i in xrange(cls.maxchunks)]
-        multi_values = ndb.get_multi(multi_keys, use_memcache=False, use_cache=False)
-        chunks = []
-        for item in multi_values:
-            if not item:
-                break # end of the line
-            if item.expires and item.expires < datetime.datetime.now():
-                logging.info("DatastoreChunkedBackend item '%s' is expired. Returning None" % (key))
-                cls.delete(key)
-                return None
-            chunks.append(item.data)
-
-        serialized = ''.join(chunks)
-        if not serialized:
-            return None
-        data = pickle.loads(serialized)
-        return data
+        return cls.get_async(key).get_result()
 
     @classmethod
     def delete(cls, key):
         """ Deletes all entires in the Datastore for the given Key's chunks."""
-        multi_keys = [ndb.Key(DatastoreCacheModel, '%s.%i' % (key, i)) for i in xrange(cls.maxchunks)]
-        ndb.delete_multi(multi_keys)
+        cls.delete_async(key).get_result()
+
+    @classmethod
+    def get_multi(cls, keys):
+        """ Loads every key in parallel, the lookups are batched by ndb. """
+        futures = [cls.get_async(key) for key in keys]
+        result = {}
+        for key, future in zip(keys, futures):
+            data = future.get_result()
+            if data is not None:
+                result[key] = data
+        return result
+
+    @classmethod
+    def set_multi(cls, mapping, ttl):
+        for future in [cls.set_async(key, data, ttl) for key, data in mapping.iteritems()]:
+            future.get_result()
+
+    @classmethod
+    def delete_multi(cls, keys):
+        for future in [cls.delete_async(key) for key in keys]:
+            future.get_result()
 
 
 class DatastoreCacheModel(ndb.Model):
@@ -352,12 +1703,50 @@ class DatastoreCacheModel(ndb.Model):
     expires = ndb.DateTimeProperty(indexed=False)
 
 
+class CacheStatsModel(ndb.Model):
+    """
+    Per-prefix totals added up by :meth:`CacheStats.flush` across instances, keyed by the
+    prefix in the default namespace. Updates are not transactional, two instances flushing
+    the same prefix at once may lose one of their increments.
+    """
+    hits = ndb.IntegerProperty(indexed=False, default=0)
+    misses = ndb.IntegerProperty(indexed=False, default=0)
+    sets = ndb.IntegerProperty(indexed=False, default=0)
+    bytes = ndb.IntegerProperty(indexed=False, default=0)
+    recompute_time = ndb.FloatProperty(indexed=False, default=0.0)
+    evictions = ndb.IntegerProperty(indexed=False, default=0)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def accumulate(cls, deltas):
+        keys = [ndb.Key(cls, prefix, namespace='') for prefix in deltas]
+        items = ndb.get_multi(keys)
+        for index, key in enumerate(keys):
+            item = items[index] or cls(key=key)
+            for field, count in deltas[key.id()].iteritems():
+                setattr(item, field, getattr(item, field) + count)
+            items[index] = item
+        ndb.put_multi(items)
+
+
+class LayeredValue(object):
+    """
+    What :class:`LayeredBackend` stores in each layer: the data and the time it expires at,
+    so copies put in faster layers never outlive the original.
+    """
+    def __init__(self, data, expires):
+        self.data = data
+        self.expires = expires
+
+
 class LayeredBackend(object):
     """
     Allows you to use multiple backends at once. When an item is cached it is put
     in to each backend. Retrieval checks each backend in order for the item. This is
     very useful when combining fast but volatile backends (like local) with slow
-    but durable backends (like datastore).
+    but durable backends (like datastore). Items found in a slower backend are put
+    back in to the faster ones for ``backfill_ttl`` seconds at most, and never past the
+    ttl they were stored with.
 
     Example::
 
@@ -366,19 +1755,92 @@ class LayeredBackend(object):
             ...
 
     """
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         self.backends = args
+        self.backfill_ttl = kwargs.get('backfill_ttl', 60)
+
+    def _wrap(self, data, ttl):
+        return LayeredValue(data, time.time() + ttl if ttl else None)
+
+    def _unwrap(self, value):
+        """
+        Returns the data and how long faster layers may keep it, 0 when they shouldn't.
+        Values stored before expiries were recorded are returned but not copied.
+        """
+        if not isinstance(value, LayeredValue):
+            return value, 0
+        if value.expires is None:
+            return value.data, self.backfill_ttl
+        remaining = value.expires - time.time()
+        if remaining <= 0:
+            return None, 0
+        if self.backfill_ttl:
+            remaining = min(remaining, self.backfill_ttl)
+        return value.data, int(remaining)
 
     def set(self, key, data, ttl):
+        value = self._wrap(data, ttl)
         for b in self.backends:
-            b.set(key, data, ttl)
+            b.set(key, value, ttl)
 
     def get(self, key):
-        for b in self.backends:
-            data = b.get(key)
+        for index, b in enumerate(self.backends):
+            value = b.get(key)
+            data, backfill_ttl = self._unwrap(value)
             if data is not None:
+                if backfill_ttl:
+                    for faster in self.backends[:index]:
+                        faster.set(key, value, backfill_ttl)
                 return data
 
     def delete(self, key):
         for b in self.backends:
             b.delete(key)
+
+    @ndb.tasklet
+    def get_async(self, key):
+        for index, b in enumerate(self.backends):
+            value = yield b.get_async(key)
+            data, backfill_ttl = self._unwrap(value)
+            if data is not None:
+                if index and backfill_ttl:
+                    yield [faster.set_async(key, value, backfill_ttl) for faster in self.backends[:index]]
+                raise ndb.Return(data)
+
+    @ndb.tasklet
+    def set_async(self, key, data, ttl):
+        value = self._wrap(data, ttl)
+        yield [b.set_async(key, value, ttl) for b in self.backends]
+
+    @ndb.tasklet
+    def delete_async(self, key):
+        yield [b.delete_async(key) for b in self.backends]
+
+    def get_multi(self, keys):
+        result = {}
+        missing = list(keys)
+        for index, b in enumerate(self.backends):
+            if not missing:
+                break
+            backfill = collections.defaultdict(dict)
+            for key, value in b.get_multi(missing).iteritems():
+                data, backfill_ttl = self._unwrap(value)
+                if data is None:
+                    continue
+                result[key] = data
+                if backfill_ttl:
+                    backfill[backfill_ttl][key] = value
+            for faster in self.backends[:index]:
+                for backfill_ttl, mapping in backfill.iteritems():
+                    faster.set_multi(mapping, backfill_ttl)
+            missing = [k for k in missing if k not in result]
+        return result
+
+    def set_multi(self, mapping, ttl):
+        mapping = dict((key, self._wrap(data, ttl)) for key, data in mapping.iteritems())
+        for b in self.backends:
+            b.set_multi(mapping, ttl)
+
+    def delete_multi(self, keys):
+        for b in self.backends:
+            b.delete_multi(keys)
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import re, os
 import weakref
+import collections
 import webapp2
 import logging
 import base64
@@ -31,6 +32,36 @@ from argeweb.components.pagination import Pagination
 _temporary_route_storage = []
 _temporary_menu_storage = []
 
+#: What a request needs to know about the handler method it is dispatched to, see
+#: :meth:`Controller._get_action_info`.
+ActionInfo = collections.namedtuple('ActionInfo', ['prefix', 'action', 'authorizations'])
+
+
+class LazyComponents(Bunch):
+    """
+    Holds the components of a controller. Components added with :meth:`defer` are only
+    constructed the first time they are used.
+    """
+    def __init__(self, controller):
+        super(LazyComponents, self).__init__(_controller=controller, _deferred={})
+
+    def defer(self, name, cls):
+        self._deferred[name] = cls
+
+    def __getattr__(self, name):
+        deferred = self.__dict__.get('_deferred', {})
+        if name not in deferred:
+            raise AttributeError(name)
+        component = deferred.pop(name)(self._controller)
+        setattr(self, name, component)
+        return component
+
+    def __contains__(self, key):
+        return key in self.__dict__ or key in self._deferred
+
+    def __iter__(self):
+        return (key for key in self.__dict__.keys() + self._deferred.keys() if not key.startswith('_'))
+
 
 def route(f):
     """
@@ -165,6 +196,10 @@ class Controller(webapp2.RequestHandler, Uri):
         # components = (scaffold.Scaffolding,)
         components = (scaffold.Scaffolding, Pagination, Search, CSRF)
 
+        #: Names of the components only constructed when an action uses them. Components that
+        #: listen to controller events in their constructor must not be listed here.
+        lazy_components = ('search', )
+
         #: Prefixes are added in from of controller (like admin_list) and will cause routing
         #: to produce a url such as '/admin/plugin/name/list' and a name such as 'admin:plugin:name:list'
         prefixes = settings.prefixes
@@ -234,16 +269,13 @@ class Controller(webapp2.RequestHandler, Uri):
 
     def __init__(self, *args, **kwargs):
         super(Controller, self).__init__(*args, **kwargs)
-        self.name = inflector.underscore(self.__class__.__name__)
+        self.name = self._get_dispatch_table().name
         self.settings = settings
         self.host_information, self.namespace, self.theme, self.server_name = self.settings.get_host_information_item()
         self.proper_name = self.__class__.__name__
         self.util = self.Util(weakref.proxy(self))
         self.logging = logging
         self.plugins = controller_helper
-        self.params = params.ParamInfo(weakref.proxy(self))
-        self.sql = mysql.CloudSQL(weakref.proxy(self))
-        self.session_store = sessions.get_store(request=self.request)
 
         self.route = None
         self.scaffold = None
@@ -264,14 +296,12 @@ class Controller(webapp2.RequestHandler, Uri):
     def _build_components(self):
         self.events.before_build_components(controller=self)
         if hasattr(self.Meta, 'components'):
-            component_classes = self.Meta.components
-            self.components = Bunch()
-            for cls in component_classes:
-                if hasattr(cls, 'name'):
-                    name = cls.name
+            self.components = LazyComponents(weakref.proxy(self))
+            for name, cls, lazy in self._get_dispatch_table().components:
+                if lazy:
+                    self.components.defer(name, cls)
                 else:
-                    name = inflector.underscore(cls.__name__)
-                self.components[name] = cls(weakref.proxy(self))
+                    self.components[name] = cls(weakref.proxy(self))
         else:
             if hasattr(self.Meta, 'Model'):
                 self.components = (scaffold.Scaffolding, )
@@ -280,18 +310,11 @@ class Controller(webapp2.RequestHandler, Uri):
         self.events.after_build_components(controller=self)
 
     def _init_route(self):
-        action = self.request.route.handler_method
-        prefix = None
-        for possible_prefix in self.Meta.prefixes:
-            if action.startswith(possible_prefix):
-                prefix = possible_prefix
-                action = action.replace(prefix + '_', '')
-                break
-
+        info = self._get_action_info(self.request.route.handler_method)
         self.route = Bunch(
-            prefix=prefix,
+            prefix=info.prefix,
             controller=self.name,
-            action=action,
+            action=info.action,
             name=self.request.route.name,
             args=self.request.route_args,
             kwargs=self.request.route_kwargs)
@@ -303,12 +326,62 @@ class Controller(webapp2.RequestHandler, Uri):
         self.meta = self.Meta(weakref.proxy(self))
         self._build_components()
 
+    @classmethod
+    def _build_dispatch_table(cls):
+        """
+        Computes what every request needs that only depends on the controller class: its
+        name, module and components. Handler methods are added by :meth:`_get_action_info`.
+        """
+        components = []
+        lazy_components = getattr(cls.Meta, 'lazy_components', ())
+        for component in getattr(cls.Meta, 'components', ()):
+            if hasattr(component, 'name'):
+                name = component.name
+            else:
+                name = inflector.underscore(component.__name__)
+            components.append((name, component, name in lazy_components))
+        # Set on the class itself, subclasses build their own.
+        cls._dispatch_table = Bunch(
+            name=inflector.underscore(cls.__name__),
+            module_name=cls.__module__,
+            components=components,
+            actions={})
+        return cls._dispatch_table
+
+    @classmethod
+    def _get_dispatch_table(cls):
+        table = cls.__dict__.get('_dispatch_table')
+        if table is None:
+            table = cls._build_dispatch_table()
+        return table
+
+    @classmethod
+    def _get_action_info(cls, handler_method):
+        """
+        Returns the prefix, action name and per-action authorizations of a handler method,
+        computed once per class.
+        """
+        actions = cls._get_dispatch_table().actions
+        info = actions.get(handler_method)
+        if info is None:
+            action = handler_method
+            prefix = None
+            for possible_prefix in cls.Meta.prefixes:
+                if action.startswith(possible_prefix):
+                    prefix = possible_prefix
+                    action = action.replace(prefix + '_', '')
+                    break
+            method = getattr(cls, handler_method, None)
+            info = actions[handler_method] = ActionInfo(prefix, action, getattr(method, 'authorizations', None))
+        return info
+
     @classmethod
     def _build_routes(cls, router):
         """
         Called in the main app router to get all of this controller's routes.
         Override to add custom/additional routes.
         """
+        cls._build_dispatch_table()
 
         # Route the rest methods
         # if str(cls).find('plugins.') > 0:
@@ -341,6 +414,7 @@ class Controller(webapp2.RequestHandler, Uri):
                     if not value:
                         continue
                     route.template = route.template.replace('['+i+']', value)
+            cls._get_action_info(route.handler_method)
             router.add(route)
         events.fire('controller_build_routes', cls=cls, router=router)
 
@@ -357,7 +431,7 @@ class Controller(webapp2.RequestHandler, Uri):
             if isinstance(self.Meta.default_view, basestring):
                 self.meta.change_view(self.Meta.default_view)
         self.prohibited_controllers = self.plugins.get_prohibited_controllers(self.host_information.plugins_list)
-        name = '.'.join(str(self).split(' object')[0][1:].split('.')[0:-1])
+        name = self._get_dispatch_table().module_name
         user_agent = ''
         if 'User-Agent' in self.request.headers:
             user_agent = self.request.headers['User-Agent']
@@ -378,9 +452,9 @@ class Controller(webapp2.RequestHandler, Uri):
         authorizations = self.meta.authorizations
 
         #per-handler authorizations
-        method = getattr(self, self.request.route.handler_method)
-        if hasattr(method, 'authorizations'):
-            authorizations = authorizations + method.authorizations
+        method_authorizations = self._get_action_info(self.request.route.handler_method).authorizations
+        if method_authorizations is not None:
+            authorizations = authorizations + method_authorizations
 
         authorizations = list(authorizations)  # convert to list so listeners can modify
 
@@ -442,11 +516,9 @@ class Controller(webapp2.RequestHandler, Uri):
         and the result is transformed into a response using the :mod:`~argeweb.core.response_handlers`.
         """
 
-        # Setup everything, the session, etc.
+        # Setup everything, the session is loaded when first used.
         self._init_meta()
 
-        self.context.set_dotted('this.session', self.session)
-
         self.events.before_startup(controller=self)
         self._startup()
         self.events.after_startup(controller=self)
@@ -482,10 +554,26 @@ class Controller(webapp2.RequestHandler, Uri):
             self.abort(500, 'Nothing was able to handle the response %s (%s)' % (result, type(result)))
         self.events.dispatch_complete(controller=self)
 
-        self.session_store.save_sessions(self.response)
+        if 'session_store' in self.__dict__:
+            self.session_store.save_sessions(self.response)
         self.events.clear()
         return self.response
 
+    @cached_property
+    def params(self):
+        return params.ParamInfo(weakref.proxy(self))
+
+    @cached_property
+    def sql(self):
+        """
+        Connection to the Cloud SQL database of the host, opened the first time it is used.
+        """
+        return mysql.CloudSQL(weakref.proxy(self))
+
+    @cached_property
+    def session_store(self):
+        return sessions.get_store(request=self.request)
+
     @cached_property
     def session(self):
         """
@@ -12,6 +12,7 @@ _plugin_installed_list = []
 _plugin_enable_list = {}
 _plugins_controller = []
 _application_controller = []
+_prohibited_controllers = {}
 
 
 def get_installed_list():
@@ -26,6 +27,7 @@ def exists(name):
 
 
 def register_controller(type_name, new_controllers):
+    _prohibited_controllers.clear()
     if type_name == 'plugins':
         global _plugins_controller
         _plugins_controller = new_controllers
@@ -55,7 +57,16 @@ def register_template(template_dir_name, templating=True, type_name='plugins'):
 def get_prohibited_controllers(enable_plugins_list):
     """
     取得沒有被啟用的 plugin 與 application 下的 controller
+    結果依啟用的 plugin 記錄於 instance 中，set_enable_plugins_to_db 時清除
     """
+    cache_key = ','.join(enable_plugins_list)
+    prohibited = _prohibited_controllers.get(cache_key)
+    if prohibited is None:
+        prohibited = _prohibited_controllers[cache_key] = frozenset(_build_prohibited_controllers(enable_plugins_list))
+    return prohibited
+
+
+def _build_prohibited_controllers(enable_plugins_list):
     a = set(get_all_controller_with_type(target_type='application') +
             get_all_controller_with_type(target_type='plugins'))
     b = []
@@ -192,4 +203,5 @@ def set_enable_plugins_to_db(server_name, namespace, plugins):
     host_item.plugins = ','.join(plugins)
     host_item.put()
     _plugin_enable_list[str(namespace)] = plugins
+    _prohibited_controllers.clear()
     namespace_manager.set_namespace(namespace)
@@ -31,7 +31,9 @@ def route_menu(*args, **kwargs):
             kwargs['plugin'] = plugin
             kwargs['controller'] = str(f.__module__)
             kwargs['action'] = action
-        _temporary_menu_storage.append(kwargs)
+        # Menus may already have been added from the route manifest.
+        if kwargs not in _temporary_menu_storage:
+            _temporary_menu_storage.append(kwargs)
         return f
     return inner
 
@@ -79,13 +79,8 @@ class HostInformationModel(BasicModel):
 
     def after_put(self, key):
         super(HostInformationModel, self).after_put(key)
-        from argeweb.core.settings import set_memcache_in_shared
-        set_memcache_in_shared('host.information.%s' % self.host, self, self.namespace)
-
-    @classmethod
-    def after_get(cls, key, item):
-        from argeweb.core.settings import set_memcache_in_shared
-        set_memcache_in_shared('host.information.%s' % item.host, item, item.namespace)
+        from argeweb.core.settings import host_information_changed
+        host_information_changed(self)
 
 
 class WebSettingModel(BasicModel):
@@ -107,6 +102,17 @@ class WebSettingModel(BasicModel):
             item.put()
         return item
 
+    def after_put(self, key):
+        super(WebSettingModel, self).after_put(key)
+        from argeweb.core.settings import datastore_setting_changed
+        datastore_setting_changed(self.setting_key, self.setting_value)
+
+    @classmethod
+    def after_delete(cls, key):
+        super(WebSettingModel, cls).after_delete(key)
+        from argeweb.core.settings import invalidate_datastore_settings
+        invalidate_datastore_settings()
+
 
 class ApplicationUserModel(BasicModel):
     name = Fields.StringProperty(required=True, verbose_name=u'名稱')
@@ -1,3 +1,7 @@
+import logging
+from ..caching import invalidate_tag
+
+__all__ = ['Behavior', 'Cacheable', 'AssetsTemplate']
 
 
 class Behavior(object):
@@ -25,3 +29,82 @@ class Behavior(object):
 
     def after_get(self, item):
         pass
+
+
+class Cacheable(Behavior):
+    """
+    Invalidates cached values that depend on a model whenever one of its items is saved or
+    deleted, so results of ``all()``, ``all_enable()`` and the fragments built from them can
+    be cached with long ttls. Values depend on the model by carrying its kind as a tag, and
+    on a single item by carrying :meth:`key_tag`. ``Meta.cache_tags`` adds more tags to
+    invalidate and ``Meta.cache_refresh`` lists callables to run afterwards, e.g. cached
+    functions that should be recomputed right away.
+
+    Example::
+
+        class ProductModel(BasicModel):
+            class Meta:
+                behaviors = (Searchable, Cacheable)
+                cache_tags = ('product_menu', )
+
+        @cache('enabled_products', ttl=86400, tags=[Cacheable.kind_tag(ProductModel)])
+        def enabled_products():
+            return ProductModel.all_enable().fetch()
+
+    """
+    @staticmethod
+    def kind_tag(Model):
+        return Model._get_kind()
+
+    @staticmethod
+    def key_tag(key):
+        return '%s:%s' % (key.kind(), key.urlsafe())
+
+    def tags_for(self, key=None):
+        tags = [self.kind_tag(self.Model)] + list(getattr(self.Model.Meta, 'cache_tags', ()))
+        if key is not None:
+            tags.append(self.key_tag(key))
+        return tags
+
+    def invalidate(self, key=None):
+        invalidate_tag(*self.tags_for(key))
+        for refresh in getattr(self.Model.Meta, 'cache_refresh', ()):
+            try:
+                refresh()
+            except Exception:
+                logging.exception('Unable to refresh %s after a change to %s' % (refresh, self.Model))
+
+    def after_put(self, instance):
+        self.invalidate(instance.key)
+
+    def after_delete(self, key):
+        self.invalidate(key)
+
+
+class AssetsTemplate(Behavior):
+    """
+    Publishes the new version of a file used as an ``assets:`` template whenever it is saved
+    or deleted, so every instance renders the change right away (see
+    :func:`argeweb.core.template.assets_changed`). The model needs ``path`` and
+    ``last_version`` properties, like the file plugin's model::
+
+        class FileModel(BasicModel):
+            class Meta:
+                behaviors = (Searchable, AssetsTemplate)
+
+    """
+    def after_put(self, instance):
+        from ..template import assets_changed, invalidate_assets
+        assets_changed(instance.path, instance.last_version)
+        # Templates that were missing until now.
+        invalidate_assets()
+
+    def before_delete(self, key):
+        item = key.get()
+        if item is not None:
+            from ..template import assets_changed
+            assets_changed(item.path, None)
+
+    def after_delete(self, key):
+        from ..template import invalidate_assets
+        invalidate_assets()
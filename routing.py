@@ -5,14 +5,28 @@ argeweb' routing utilities
 """
 
 import os
+import json
+import time
+import urllib
 import inspect
+import threading
 import webapp2
 import logging
 import argeweb
 import inflector
+import menu
+from caching import LayeredBackend, MemcacheBackend, DatastoreBackend
+from google.appengine.api import namespace_manager
 from webapp2 import Route
 from webapp2_extras import routes
 
+#: Written by :func:`write_manifest` before deploying, used instead of discovering controllers.
+#: It is trusted for the ``version`` it was built for, write it again for every deployment.
+manifest_path = os.path.normpath(os.path.join(os.path.dirname(argeweb.__file__), '..', 'route_manifest.json'))
+
+#: Where the first instance of a deployment saves the manifest when no file was deployed.
+manifest_backend = LayeredBackend(MemcacheBackend, DatastoreBackend)
+
 
 def get_true_name_and_argspec(method):
     """
@@ -40,16 +54,312 @@ def add(route, app_router=None):
     app_router.add(route)
 
 
-def auto_route(app_router, version=u''):
+def auto_route(app_router, version=u'', lazy=False):
+    """
+    Automatically routes all controllers in main app and plugins.
+
+    Outside the development server the controllers, their routes, template directories and
+    menus are recorded in a manifest (see :func:`load_manifest`), so the next instances of
+    the same deployment neither look for controllers nor import them: their routes are
+    added from the manifest and webapp2 imports a controller on its first request. With
+    ``lazy`` each controller is represented by a single :class:`LazyControllerRoute`
+    instead, which only matches requests under its paths. Either way controllers that
+    register events or other side effects when imported should not rely on being imported
+    at startup.
+    """
+    started = time.time()
+    manifest = None if _is_dev_server() else load_manifest(version)
+    if manifest is not None:
+        route_from_manifest(app_router, manifest, lazy=lazy)
+    else:
+        manifest = _build_manifest(app_router, version)
+        if not _is_dev_server():
+            save_manifest(manifest)
+    logging.info('Routed %d controllers in %.3fs' % (len(manifest['controllers']), time.time() - started))
+
+
+def _is_dev_server():
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Dev')
+
+
+def _manifest_key(version):
     """
-    Automatically routes all controllers in main app and plugins
+    Deployed code never changes, so saved manifests are per deployment. None when the
+    deployment is unknown.
     """
+    deployment = os.environ.get('CURRENT_VERSION_ID')
+    if not deployment:
+        return None
+    return 'routing.manifest:%s:%s' % (deployment, version)
+
+
+def _build_manifest(app_router, version):
     import controller_helper
+    entries = []
     for item in controller_helper.get_all_controller(version):
         try:
-            route_controllers(app_router, item)
+            entry = route_controllers(app_router, item)
+            if entry is not None:
+                entries.append(entry)
         except ImportError as e:
             logging.error('Plugin %s does not exist, or contains a bad import: %s' % (item, e))
+    return {
+        'version': version,
+        'application': controller_helper.get_all_controller_with_type('application'),
+        'plugins': controller_helper.get_all_controller_with_type('plugins'),
+        'controllers': entries,
+    }
+
+
+def build_manifest(version=u''):
+    """
+    Imports every controller and returns the manifest :func:`auto_route` would record.
+    """
+    return _build_manifest(webapp2.Router(), version)
+
+
+def write_manifest(manifest, path=None):
+    """
+    Writes a manifest to ``manifest_path``, meant to be run before deploying.
+    """
+    with open(path or manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def load_manifest(version=u''):
+    """
+    Returns the manifest written by :func:`write_manifest` for this ``version``, or the one
+    saved by the first instance of this deployment, or None.
+    """
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == version:
+                return manifest
+            logging.warning('Ignoring the route manifest %s, it was built for version %s' % (
+                manifest_path, manifest.get('version')))
+        except ValueError as e:
+            logging.error('Unable to read the route manifest %s: %s' % (manifest_path, e))
+    key = _manifest_key(version)
+    if key is None:
+        return None
+    namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace('')
+    try:
+        return manifest_backend.get(key)
+    finally:
+        namespace_manager.set_namespace(namespace)
+
+
+def save_manifest(manifest):
+    key = _manifest_key(manifest['version'])
+    if key is None:
+        logging.warning('Not saving the route manifest, CURRENT_VERSION_ID is not set')
+        return
+    namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace('')
+    try:
+        manifest_backend.set(key, manifest, 0)
+    except Exception as e:
+        logging.warning('Unable to save the route manifest: %s' % e)
+    finally:
+        namespace_manager.set_namespace(namespace)
+
+
+def drop_manifest(version=u''):
+    """
+    Drops the manifest saved for this deployment, so the next instance discovers the
+    controllers again.
+    """
+    key = _manifest_key(version)
+    if key is None:
+        return
+    namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace('')
+    try:
+        manifest_backend.delete(key)
+    finally:
+        namespace_manager.set_namespace(namespace)
+
+
+def _static_prefix(template):
+    """
+    Returns the part of a route template before its first variable.
+    """
+    return template.split('<', 1)[0]
+
+
+def _route_from_description(kwargs):
+    return Route(**dict((str(k), v) for k, v in kwargs.iteritems()))
+
+
+class LazyControllerRoute(webapp2.BaseRoute):
+    """
+    Stands in for the routes of a controller recorded in the manifest. Only requests under
+    the static part of one of its route templates import the controller and expand its real
+    routes, names are built from the manifest so ``uri()`` and :func:`route_name_exists`
+    work before that.
+    """
+    def __init__(self, entry):
+        super(LazyControllerRoute, self).__init__(None)
+        self.controller_path = entry['path']
+        self.described = entry['routes']
+        self.prefixes = tuple(set(
+            _static_prefix(kwargs['template']) for kwargs in self.described if not kwargs['build_only']))
+        self.expanded = None
+        self.lock = threading.Lock()
+
+    def get_build_routes(self):
+        for kwargs in self.described:
+            if kwargs['name'] is not None:
+                yield kwargs['name'], _route_from_description(kwargs)
+
+    def expand(self):
+        """
+        Imports the controller and returns the routes it adds, once.
+        """
+        if self.expanded is None:
+            with self.lock:
+                if self.expanded is None:
+                    collector = _RouteCollector()
+                    route_controllers(collector, self.controller_path)
+                    expanded = []
+                    for route in collector.routes:
+                        expanded.extend(route.get_match_routes())
+                    self.expanded = expanded
+        return self.expanded
+
+    def match(self, request):
+        if not urllib.unquote(request.path).startswith(self.prefixes):
+            return None
+        method_not_allowed = False
+        for route in self.expand():
+            try:
+                match = route.match(request)
+                if match:
+                    return match
+            except webapp2.exc.HTTPMethodNotAllowed:
+                method_not_allowed = True
+        if method_not_allowed:
+            raise webapp2.exc.HTTPMethodNotAllowed()
+        return None
+
+    def __repr__(self):
+        return '<LazyControllerRoute(%r, %r)>' % (self.controller_path, self.prefixes)
+
+
+def _static_segments(route):
+    """
+    Returns the lists of path segments every request matched by a route starts with, or
+    ``[[]]`` when nothing is known about its path.
+    """
+    if isinstance(route, LazyControllerRoute):
+        return [prefix.split('/')[1:-1] for prefix in route.prefixes]
+    if isinstance(route, Route) and route.template.startswith('/'):
+        if '<' in route.template:
+            return [_static_prefix(route.template).split('/')[1:-1]]
+        return [route.template.split('/')[1:]]
+    return [[]]
+
+
+class TrieRouter(webapp2.Router):
+    """
+    Router that indexes routes by the static segments their templates start with (prefix,
+    plugin, controller and so on), so a request is only matched against the routes that
+    can match its path instead of every route. Candidates are tried in the order they were
+    added, keeping names, handler methods and precedence the same as webapp2's router.
+
+    Example::
+
+        app = webapp2.WSGIApplication(debug=debug)
+        app.router = routing.TrieRouter()
+        routing.auto_route(app.router, version)
+
+    """
+    def __init__(self, routes=None):
+        # Each node is [[(order, route), ...], {segment: node}].
+        self.trie = [[], {}]
+        super(TrieRouter, self).__init__(routes)
+
+    def add(self, route):
+        if isinstance(route, tuple):
+            route = self.route_class(*route)
+        for r in route.get_match_routes():
+            order = len(self.match_routes)
+            for segments in _static_segments(r):
+                node = self.trie
+                for segment in segments:
+                    node = node[1].setdefault(segment, [[], {}])
+                node[0].append((order, r))
+            self.match_routes.append(r)
+        for name, r in route.get_build_routes():
+            self.build_routes[name] = r
+
+    def candidates(self, path):
+        """
+        Returns the routes that may match a path, in the order they were added.
+        """
+        node = self.trie
+        found = list(node[0])
+        for segment in path.split('/')[1:]:
+            node = node[1].get(segment)
+            if node is None:
+                break
+            found.extend(node[0])
+        found.sort(key=lambda entry: entry[0])
+        routes_list = []
+        last = None
+        for order, route in found:
+            # Routes indexed under several prefixes may be found twice.
+            if order != last:
+                routes_list.append(route)
+                last = order
+        return routes_list
+
+    def default_matcher(self, request):
+        method_not_allowed = False
+        for route in self.candidates(urllib.unquote(request.path)):
+            try:
+                match = route.match(request)
+                if match:
+                    return match
+            except webapp2.exc.HTTPMethodNotAllowed:
+                method_not_allowed = True
+
+        if method_not_allowed:
+            raise webapp2.exc.HTTPMethodNotAllowed()
+        raise webapp2.exc.HTTPNotFound()
+
+    match = default_matcher
+
+
+def route_from_manifest(app_router, manifest, lazy=False):
+    """
+    Routes the controllers recorded in a manifest without importing them, see
+    :func:`auto_route`. Controllers whose routes could not be recorded are imported and
+    route themselves.
+    """
+    import controller_helper
+    controller_helper.register_controller('application', manifest['application'])
+    controller_helper.register_controller('plugins', manifest['plugins'])
+    for entry in manifest['controllers']:
+        if entry['routes'] is None:
+            try:
+                route_controllers(app_router, entry['path'])
+            except ImportError as e:
+                logging.error('Plugin %s does not exist, or contains a bad import: %s' % (entry['path'], e))
+            continue
+        if lazy:
+            app_router.add(LazyControllerRoute(entry))
+        else:
+            for kwargs in entry['routes']:
+                app_router.add(_route_from_description(kwargs))
+        for template_dir_name, type_name in entry['templates']:
+            controller_helper.register_template(template_dir_name, type_name=type_name)
+        for item in entry['menus']:
+            if item not in menu._temporary_menu_storage:
+                menu._temporary_menu_storage.append(item)
 
 
 def redirect(url, to, app_router=None):
@@ -59,10 +369,45 @@ def redirect(url, to, app_router=None):
     add(routes.RedirectRoute(url, redirect_to=to), app_router)
 
 
+class _RouteCollector(object):
+    """
+    Stands in for the router while a controller adds its routes.
+    """
+    def __init__(self):
+        self.routes = []
+
+    def add(self, route):
+        self.routes.append(route)
+
+
+def _describe_routes(route_list):
+    """
+    Returns the arguments to create each route again, or None if any of them is not a
+    plain :class:`webapp2.Route` of a controller class.
+    """
+    described = []
+    for route in route_list:
+        leaves = route.get_routes() if isinstance(route, routes.NamePrefixRoute) else [route]
+        for leaf in leaves:
+            if type(leaf) is not Route or not inspect.isclass(leaf.handler):
+                return None
+            described.append({
+                'template': leaf.template,
+                'handler': '%s.%s' % (leaf.handler.__module__, leaf.handler.__name__),
+                'name': leaf.name,
+                'defaults': leaf.defaults,
+                'build_only': leaf.build_only,
+                'handler_method': leaf.handler_method,
+                'methods': leaf.methods,
+                'schemes': leaf.schemes,
+            })
+    return described
+
+
 def route_controllers(app_router, controller_path=None):
     """
     Called in app.routes to automatically route all controllers in the app/controllers
-    folder
+    folder. Returns the controller's manifest entry, see :func:`auto_route`.
     """
     import controller_helper
     sp = ('%s' % controller_path).split('.')
@@ -70,12 +415,22 @@ def route_controllers(app_router, controller_path=None):
     plugin_name = sp[1]
     controller_name = sp[-1]
     try:
+        menus_before = len(menu._temporary_menu_storage)
         module = __import__('%s' % controller_path, fromlist=['*'])
         try:
             controller_cls = getattr(module, inflector.camelize(controller_name))
-            controller_cls._build_routes(app_router)
+            collector = _RouteCollector()
+            controller_cls._build_routes(collector)
+            for route in collector.routes:
+                app_router.add(route)
             controller_helper.register_template(plugin_name, type_name=type_name)
             controller_helper.register_template(controller_name, type_name=type_name)
+            return {
+                'path': controller_path,
+                'routes': _describe_routes(collector.routes),
+                'templates': [[plugin_name, type_name], [controller_name, type_name]],
+                'menus': menu._temporary_menu_storage[menus_before:],
+            }
         except AttributeError:
             logging.debug('Controller %s not found, skipping' % inflector.camelize(controller_name))
     except ImportError as e:
@@ -6,15 +6,28 @@
 # Web: http://www.yooliang.com/
 # Date: 2014/9/30
 import os
+import copy
+import time
 import logging
 import inspect
+import threading
 from . import events
+from .event import Event
 from .model import HostInformationModel, WebSettingModel
 from google.appengine.api import namespace_manager
 from google.appengine.api import memcache
 
 _defaults = {}
+_snapshot = None
+_snapshot_lock = threading.RLock()
+_generation = 0
 _host_information = {}
+_datastore_settings = {}
+#: Seconds the datastore settings of a namespace are used before memcache is checked again.
+datastore_settings_ttl = 10
+datastore_settings_memcache_key = 'setting.bundle'
+#: Seconds a host information is used before its version stamp in memcache is checked again.
+host_information_ttl = 10
 prefixes = ['admin', 'cron', 'console', 'dashboard', 'taskqueue']
 
 
@@ -22,6 +35,60 @@ class ConfigurationError(Exception):
     pass
 
 
+class SettingsSnapshot(dict):
+    """
+    Read-only settings compiled by :func:`settings`, along with the generation it was
+    built at. Copies and unpickled snapshots are plain dicts.
+    """
+    def __init__(self, values, generation):
+        super(SettingsSnapshot, self).__init__(values)
+        self.generation = generation
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Settings are read-only, use settings.defaults() to change them')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return dict, (dict(self), )
+
+
+class SettingsEvent(Event):
+    """
+    Drops the compiled settings whenever a ``before_settings`` or ``after_settings``
+    listener is added or removed.
+    """
+    def handle(self, handler, priority=0):
+        super(SettingsEvent, self).handle(handler, priority)
+        invalidate()
+        return self
+
+    def unhandle(self, handler, priority=0):
+        super(SettingsEvent, self).unhandle(handler, priority)
+        invalidate()
+        return self
+
+    __iadd__ = handle
+    __isub__ = unhandle
+
+
+def _watch_listeners():
+    for name in ('before_settings', 'after_settings'):
+        event = SettingsEvent(name=name)
+        # Listeners registered before this module was imported.
+        event.handlers = events.global_events[name].handlers
+        events.global_events[name] = event
+
+
+_watch_listeners()
+
+
 def load_settings(app_settings=None, refresh=False):
     """
     Executed when the project is created and loads the settings from application/settings.py
@@ -57,20 +124,52 @@ def defaults(dict=None):
     If dict is None, it'll return the current defaults.
     """
     if dict:
-        _defaults.update(dict)
+        with _snapshot_lock:
+            _defaults.update(dict)
+            invalidate()
     else:
         return _defaults
 
 
+def invalidate():
+    """
+    Drops the compiled settings. Call it from a ``before_settings`` or ``after_settings``
+    listener when the values it adds change, or after changing :func:`defaults` in place.
+    """
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
+
+
+def generation():
+    """
+    Returns a number that changes every time the settings are compiled again.
+    """
+    return settings().generation
+
+
+def _compile():
+    global _snapshot, _generation
+    with _snapshot_lock:
+        _settings = {}
+        events.fire('before_settings', settings=_settings)
+        _settings.update(_defaults)
+        events.fire('after_settings', settings=_settings)
+        _generation += 1
+        _snapshot = SettingsSnapshot(_settings, _generation)
+        return _snapshot
+
+
 def settings():
     """
-    Returns the entire settings registry
+    Returns the entire settings registry. The registry is compiled once into a read-only
+    snapshot, rebuilt after :func:`defaults` or :func:`invalidate` or when a settings
+    listener is added or removed.
     """
-    _settings = {}
-    events.fire('before_settings', settings=_settings)
-    _settings.update(_defaults)
-    events.fire('after_settings', settings=_settings)
-    return _settings
+    snapshot = _snapshot
+    if snapshot is None:
+        snapshot = _compile()
+    return snapshot
 
 
 def print_setting(key):
@@ -89,43 +188,85 @@ def get(key, default=None):
     if default is None:
         raise ConfigurationError('Missing setting %s' % key)
     else:
-        _defaults.update({key: default})
+        defaults({key: default})
         return default
 
 
 def save_to_datastore(setting_key, setting_value, use_memcache=True, prefix=u''):
-    _prefix = prefix
-    if _prefix is not u'':
-        _prefix += '.'
-    memcache_key = 'setting.' + _prefix + setting_key
+    """
+    Saves a setting, :meth:`WebSettingModel.after_put` writes it through to the cached
+    settings of the namespace. ``use_memcache`` and ``prefix`` are kept for compatibility.
+    """
     item = WebSettingModel.get_or_insert(key=setting_key, default=setting_value)
-    item.setting_value = setting_value
-    item.put()
-    if use_memcache:
-        memcache.set(key=memcache_key, value=setting_value, time=120)
+    if item.setting_value != setting_value:
+        item.setting_value = setting_value
+        item.put()
+
+
+def _get_datastore_settings():
+    """
+    Returns every setting stored in the datastore for the current namespace as a dict,
+    loaded with a single query and kept in memcache and in this instance.
+    """
+    namespace = namespace_manager.get_namespace()
+    cached = _datastore_settings.get(namespace)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    values = memcache.get(datastore_settings_memcache_key)
+    if values is None:
+        values = dict((item.setting_key, item.setting_value) for item in WebSettingModel.query().fetch())
+        memcache.add(key=datastore_settings_memcache_key, value=values, time=120)
+    _datastore_settings[namespace] = (values, time.time() + datastore_settings_ttl)
+    return values
+
+
+def datastore_setting_changed(setting_key, setting_value):
+    """
+    Writes a saved setting through to the cached settings of the current namespace.
+    """
+    namespace = namespace_manager.get_namespace()
+    cached = _datastore_settings.get(namespace)
+    if cached is not None:
+        values = dict(cached[0])
+        values[setting_key] = setting_value
+        _datastore_settings[namespace] = (values, cached[1])
+    client = memcache.Client()
+    values = client.gets(datastore_settings_memcache_key)
+    if values is None:
+        return
+    values = dict(values)
+    values[setting_key] = setting_value
+    if not client.cas(datastore_settings_memcache_key, values, time=120):
+        # Someone else changed the settings meanwhile, let the next request load them again.
+        memcache.delete(datastore_settings_memcache_key)
+
+
+def invalidate_datastore_settings():
+    _datastore_settings.pop(namespace_manager.get_namespace(), None)
+    memcache.delete(datastore_settings_memcache_key)
 
 
 def get_from_datastore(setting_key, default=None, auto_save=True, use_memcache=True, prefix=u''):
+    """
+    Returns a setting stored in the datastore, saving ``default`` when it is missing and
+    ``auto_save`` is set. Settings are served from :func:`_get_datastore_settings` unless
+    ``use_memcache`` is False. ``prefix`` is kept for compatibility.
+    """
     if default is None:
         default = u''
-    _prefix = prefix
-    if _prefix is not u'':
-        _prefix += '.'
-    memcache_key = 'setting.' + _prefix + setting_key
     if use_memcache:
-        data = memcache.get(memcache_key)
-        if data is not None:
-            return data
+        values = _get_datastore_settings()
+        if setting_key in values:
+            return values[setting_key]
+        if not auto_save:
+            return default
+        return WebSettingModel.get_or_insert(key=setting_key, default=default).setting_value
     if auto_save:
         item = WebSettingModel.get_or_insert(key=setting_key, default=default)
     else:
         item = WebSettingModel.get_by_key(key=setting_key)
-    if use_memcache:
-        if item is None:
-            memcache.add(key=memcache_key, value=default, time=120)
-            return default
-        else:
-            memcache.add(key=memcache_key, value=item.setting_value, time=120)
+    if item is None:
+        return default
     return item.setting_value
 
 
@@ -168,13 +309,40 @@ def get_server_name():
     return server_name
 
 
-def get_host_information_item(server_name=None):
-    global _host_information
-    if server_name is None:
-        server_name = get_server_name()
-    host_item = get_memcache_in_shared('host.information.' + server_name)
-    sn = []
+def _host_information_keys(server_name):
+    return 'host.information.' + server_name, 'host.information.version.' + server_name
+
+
+def _get_local_host_information(server_name):
+    """
+    Returns the host information remembered by this instance, checking that its version
+    stamp is still current once the entry is older than ``host_information_ttl``.
+    """
+    cached = _host_information.get(server_name)
+    if cached is None:
+        return None
+    host_item, version, expires = cached
+    if expires > time.time():
+        return host_item
+    if get_memcache_in_shared(_host_information_keys(server_name)[1]) != version:
+        _host_information.pop(server_name, None)
+        return None
+    _host_information[server_name] = (host_item, version, time.time() + host_information_ttl)
+    return host_item
+
+
+def _load_host_information(server_name):
+    item_key, version_key = _host_information_keys(server_name)
+    namespace_manager.set_namespace('shared')
+    # The version is read before the item, so a change made meanwhile is noticed on the next check.
+    found = memcache.get_multi([item_key, version_key])
+    version = found.get(version_key)
+    if version is None:
+        memcache.add(version_key, int(time.time() * 1000))
+        version = memcache.get(version_key)
+    host_item = found.get(item_key)
     if host_item is None:
+        sn = []
         for n in 'application_user,backend_ui_material,webdav,scaffold,themes,' \
                  'file,user_file,code,plugin_manager,zz_last_path'.split(','):
             sn.append('plugins.%s' % n)
@@ -184,8 +352,39 @@ def get_host_information_item(server_name=None):
             plugins=','.join(sn),
             is_lock=True
         )
+        namespace_manager.set_namespace('shared')
+        memcache.add(key=item_key, value=host_item, time=120)
+    if version is not None:
+        _host_information[server_name] = (host_item, version, time.time() + host_information_ttl)
+    return host_item
+
+
+def host_information_changed(host_item):
+    """
+    Called when a host information is saved, stores it in memcache and bumps its version
+    stamp so every instance reloads it.
+    """
+    item_key, version_key = _host_information_keys(host_item.host)
+    current_namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace('shared')
+    memcache.set(key=item_key, value=host_item, time=120)
+    memcache.incr(version_key, initial_value=int(time.time() * 1000))
+    namespace_manager.set_namespace(current_namespace)
+    _host_information.pop(host_item.host, None)
+
+
+def get_host_information_item(server_name=None):
+    """
+    Returns the host information of the server along with its namespace and theme, and
+    switches to its namespace. The item is kept in this instance and shared by every
+    request, so it costs no RPC until its version stamp changes.
+    """
+    if server_name is None:
+        server_name = get_server_name()
+    host_item = _get_local_host_information(server_name)
+    if host_item is None:
+        host_item = _load_host_information(server_name)
     namespace_manager.set_namespace(host_item.namespace)
-    set_memcache_in_shared('host.information.' + server_name, host_item, host_item.namespace)
     host_item.is_dev_server = os.environ.get('SERVER_SOFTWARE', '').startswith('Dev')
     return host_item, host_item.namespace, host_item.theme, server_name
 
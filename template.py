@@ -3,9 +3,13 @@ argeweb' templating engine.
 """
 
 from google.appengine.api import users, app_identity
+from google.appengine.api import memcache, namespace_manager
 from google.appengine.ext import db, ndb
 from routing import route_name_exists, current_route_name
 from jinja2.exceptions import TemplateNotFound
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.utils import LRUCache
 from json_util import DatastoreEncoder
 from settings import settings
 import logging
@@ -13,36 +17,313 @@ import os
 import math
 import datetime
 import json
+import hashlib
 import jinja2
 import types
 import collections
 import argeweb
 import events
+import caching
 import time
 import time_util
 import random
+import threading
 
 debug = os.environ.get('SERVER_SOFTWARE', '').startswith('Dev')
 
+#: Number of compiled templates each engine keeps, 0 compiles templates on every render.
+cache_size = 400
+
+#: Where compiled templates are shared: ``'memcache'``, a directory, a ``jinja2.BytecodeCache``
+#: or None.
+bytecode_cache = None if debug else 'memcache'
+
+#: Seconds the version of an ``assets:`` template is trusted before asking the datastore again.
+#: Models whose files are ``assets:`` templates should use the ``AssetsTemplate`` behavior
+#: (see :mod:`argeweb.core.ndb.behavior`), otherwise edits show up after this delay
+#: (immediately when ``view_cache`` is off).
+assets_version_ttl = 60
+
+#: Tag (see :func:`caching.invalidate_tag`) whose generation ``assets:`` templates depend on.
+assets_tag = 'template.assets'
+
+#: Number of ``assets:`` template sources kept in process.
+assets_source_cache_size = 200
+
+#: Number of resolved and missing template names each engine remembers.
+resolution_cache_size = 1000
+
+#: Where :func:`compile_templates` writes the compiled templates, one folder per theme.
+compiled_templates_path = os.path.normpath(os.path.join(os.path.dirname(argeweb.__file__), '../compiled_templates'))
+
+#: Extensions of the files :func:`compile_templates` compiles.
+compiled_templates_extensions = ('html', )
+
+#: Written next to the compiled templates, the checksum of each template's source.
+compiled_checksums_filename = 'checksums.json'
+
+#: Load templates from ``compiled_templates_path`` when it has a folder for the theme. A
+#: compiled template is only used while the checksum of its source matches the one recorded
+#: by :func:`compile_templates`.
+use_compiled_templates = False
+
+#: Backend of the ``{% cache %}`` tag (see :mod:`caching`), None renders fragments every time.
+fragment_cache_backend = 'memcache'
+
+_assets_sources = {}
+_assets_local = threading.local()
+
+
+def invalidate_assets(namespace=None):
+    """
+    Makes every instance reload the ``assets:`` templates of the current (or given) namespace
+    on its next render, and look again for the ones that were missing. Call it after
+    templates stored in the datastore are created or removed.
+    """
+    caching.invalidate_tag(assets_tag, namespace=namespace)
+
+
+def _assets_generation():
+    """
+    Generation of the ``assets:`` templates of the current namespace, read from memcache
+    once per :func:`render_template` and only by renders that use such templates.
+    """
+    state = getattr(_assets_local, 'render', None)
+    if state is not None and state['generation'] is not None:
+        return state['generation']
+    generation = caching.get_tag_versions([assets_tag]).get(assets_tag, 0)
+    if state is not None:
+        state['generation'] = generation
+    return generation
+
+
+def _current_assets_version(path):
+    """
+    Version of an ``assets:`` template, read once per :func:`render_template` (from the
+    datastore when the render doesn't use the cache).
+    """
+    state = getattr(_assets_local, 'render', None)
+    if state is None:
+        return get_assets_version(path)
+    if path not in state['versions']:
+        state['versions'][path] = get_assets_version(path, check=state['check'])
+    return state['versions'][path]
+
+
+def assets_changed(path, version):
+    """
+    Publishes the new version of an ``assets:`` template of the current namespace, so every
+    instance picks it up on its next render instead of after ``assets_version_ttl``. None
+    means the template was removed.
+    """
+    key = 'assets.version:%s' % _assets_path(path)
+    if version is None:
+        memcache.delete(key)
+    else:
+        memcache.set(key, version, time=assets_version_ttl)
+
+
+def _assets_path(template):
+    template = template.replace(u'assets:', u'', 1).split('?')[0]
+    if template.startswith(u'/'):
+        template = template[1:]
+    return template
+
+
+def get_assets_version(path, check=False):
+    """
+    Returns the ``last_version`` of an ``assets:`` template of the current namespace, or None
+    if there is no such file. With ``check`` the datastore is asked even if memcache knows it.
+    """
+    key = 'assets.version:%s' % path
+    if not check:
+        version = memcache.get(key)
+        if version is not None:
+            return version
+    from plugins.file.models.file_model import get_file
+    t = get_file(path)
+    if t is None:
+        return None
+    memcache.set(key, t.last_version, time=assets_version_ttl)
+    return t.last_version
+
+
+def get_assets_source(path, version):
+    """
+    Returns the source of an ``assets:`` template at the given version. Versions never
+    change once saved, so sources are kept in process and in memcache without expiring.
+    """
+    local_key = (namespace_manager.get_namespace(), path, version)
+    source = _assets_sources.get(local_key)
+    if source is not None:
+        return source
+    key = 'assets.source:%s:%s' % (path, version)
+    source = memcache.get(key)
+    if source is None:
+        from plugins.code.models.code_model import get_source
+        from plugins.file.models.file_model import get_file
+        s = get_source(target=get_file(path), version=version)
+        if s is None:
+            return None
+        source = s.source
+        memcache.set(key, source)
+    if len(_assets_sources) >= assets_source_cache_size:
+        _assets_sources.clear()
+    _assets_sources[local_key] = source
+    return source
+
+
+def _unchanged():
+    return True
+
+
+def _checksum(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def _remember(cache, key, value, size):
+    # Names come from request paths, so keep the memo bounded.
+    if len(cache) >= size:
+        cache.clear()
+    cache[key] = value
+
+
+def _resolution_key(names):
+    """
+    Results for ``assets:`` templates depend on the namespace and change with
+    :func:`invalidate_assets`, the filesystem is the same for everyone.
+    """
+    if any(name.startswith(u'assets:') for name in names):
+        namespace = namespace_manager.get_namespace()
+        return names, namespace, _assets_generation()
+    return names
+
+
+def _resolution_expires(names):
+    # Missing assets: templates may be created at any time, missing files may not.
+    if any(name.startswith(u'assets:') for name in names):
+        return time.time() + assets_version_ttl
+    return None
+
+
+def _is_fresh(expires):
+    return expires is None or expires > time.time()
+
+
+class TemplateCache(LRUCache):
+    """
+    Jinja2 keys compiled templates by name, ``assets:`` templates are also keyed by the
+    namespace they were loaded in since every namespace has its own.
+    """
+    def _key(self, name):
+        if isinstance(name, basestring) and name.startswith(u'assets:'):
+            return namespace_manager.get_namespace(), name
+        return name
+
+    def __contains__(self, name):
+        return super(TemplateCache, self).__contains__(self._key(name))
+
+    def __getitem__(self, name):
+        return super(TemplateCache, self).__getitem__(self._key(name))
+
+    def __setitem__(self, name, template):
+        super(TemplateCache, self).__setitem__(self._key(name), template)
+
+    def __delitem__(self, name):
+        super(TemplateCache, self).__delitem__(self._key(name))
+
+
+class MemcacheBytecodeCache(jinja2.BytecodeCache):
+    """
+    Shares compiled templates between instances through memcache, in the current namespace.
+    Jinja2 compares the stored checksum with the template source before using an entry.
+    """
+    def __init__(self, prefix, timeout=86400):
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def load_bytecode(self, bucket):
+        code = memcache.get(self.prefix + bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        memcache.set(self.prefix + bucket.key, bucket.bytecode_to_string(), time=self.timeout)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Caches the output of a block through the :mod:`caching` backends, per namespace and
+    theme. The ttl (0 keeps the fragment until it's evicted) and the tags are optional,
+    :func:`caching.invalidate_tag` drops every fragment carrying one of the tags::
+
+        {% cache 'product_menu', 3600, ['ProductModel'] %}
+            {% for item in get_route_menu(...) %}...{% endfor %}
+        {% endcache %}
+
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache_backend=fragment_cache_backend, fragment_cache_theme=None)
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+        args = [parser.parse_expression()]
+        for default in (nodes.Const(0), nodes.Const(None)):
+            if parser.stream.skip_if('comma'):
+                args.append(parser.parse_expression())
+            else:
+                args.append(default)
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, ttl, tags, caller):
+        if self.environment.fragment_cache_backend is None:
+            return caller()
+        if isinstance(tags, basestring):
+            tags = [tags]
+        key = caching.build_cache_key('template.fragment', (
+            namespace_manager.get_namespace(), self.environment.fragment_cache_theme, key))
+        return caching.get_or_set(key, caller, ttl, self.environment.fragment_cache_backend, tags)
+
 
 class TemplateEngine(object):
     def __init__(self, theme=None, extra_globals=None, extra_paths=None):
         self.theme = theme
+        self._resolved = {}
         jinja2_env_kwargs = {
             'loader': self._build_loader(extra_paths=extra_paths),
-            'auto_reload': False,
-            # 'cache_size':  0 if debug else 50,
-            'cache_size':  0,
+            # Only assets templates (and files on the development server) can change, see
+            # the uptodate functions returned by the loader.
+            'auto_reload': True,
+            'cache_size': cache_size,
+            'bytecode_cache': self._build_bytecode_cache(),
             'variable_start_string': "{{ ",
             'variable_end_string': " }}",
-            'extensions': ['jinja2.ext.do']
+            'extensions': ['jinja2.ext.do', FragmentCacheExtension]
         }
         events.fire('before_jinja2_environment_creation', engine=self, jinja2_env_kwargs=jinja2_env_kwargs)
         self.environment = jinja2.Environment(**jinja2_env_kwargs)
+        if isinstance(self.environment.cache, LRUCache):
+            self.environment.cache = TemplateCache(self.environment.cache.capacity)
+        self.environment.fragment_cache_theme = theme
         events.fire('after_jinja2_environment_creation', engine=self)
         self._update_globals(extra_globals)
         events.fire('template_engine_created', self)
 
+    def _build_bytecode_cache(self):
+        if bytecode_cache == 'memcache':
+            return MemcacheBytecodeCache('jinja2.bytecode:%s:%s:' % (
+                self.theme, os.environ.get('CURRENT_VERSION_ID', '')))
+        if isinstance(bytecode_cache, basestring):
+            return jinja2.FileSystemBytecodeCache(bytecode_cache, '__jinja2_%s_%%s.cache' % (self.theme or ''))
+        return bytecode_cache
+
+    def _compiled_templates_path(self, target=None):
+        return os.path.join(target or compiled_templates_path, self.theme or '__default__')
+
     def _build_loader(self, extra_paths=None):
         # Paths for resolving template file locations
         non_prefix_template_paths = [
@@ -73,47 +354,78 @@ class TemplateEngine(object):
             ] + non_prefix_template_paths
 
         class ChoiceLoader(jinja2.ChoiceLoader):
+            def __init__(self, loaders, module_loader=None, checksums=None):
+                super(ChoiceLoader, self).__init__(loaders)
+                self.module_loader = module_loader
+                self.checksums = checksums or {}
+                self.missing = {}
+
+            def load(self, environment, name, globals=None):
+                checksum = self.checksums.get(name.lstrip(u'/'))
+                if self.module_loader is not None and checksum is not None:
+                    source = self.get_source(environment, name)[0]
+                    if _checksum(source) == checksum:
+                        return self.module_loader.load(environment, name.lstrip(u'/'), globals)
+                    logging.warning('Compiled template %s is out of date, using its source' % name)
+                return super(ChoiceLoader, self).load(environment, name, globals)
+
+            def list_templates(self):
+                # assets: templates live in the datastore and cannot be listed.
+                found = set()
+                for loader_item in self.loaders:
+                    if not isinstance(loader_item, jinja2.FunctionLoader):
+                        found.update(loader_item.list_templates())
+                return sorted(found)
+
             def get_source(self, environment, template):
+                key = _resolution_key((template, ))
+                if key in self.missing and _is_fresh(self.missing[key]):
+                    raise TemplateNotFound(template)
                 is_assets = template.startswith(u'assets:')
                 for loader_item in self.loaders:
-                    # loader_name = str(loader)
-                    # if is_assets and loader_name.find('FunctionLoader') < 0:
-                    #     continue
-                    # if is_assets is True and loader_name.find('FunctionLoader') > 0:
-                    #     continue
-                    is_function_loader = str(loader_item).find('FunctionLoader') > 0
-                    if is_assets and is_function_loader is False:
-                        continue
-                    if is_assets is False and is_function_loader:
+                    is_function_loader = isinstance(loader_item, jinja2.FunctionLoader)
+                    if is_assets is not is_function_loader:
                         continue
                     try:
-                        return loader_item.get_source(environment, template)
+                        source, filename, uptodate = loader_item.get_source(environment, template)
                     except TemplateNotFound:
-                        pass
+                        continue
+                    if not is_function_loader and not debug:
+                        # Deployed files never change, skip the stat on every render.
+                        uptodate = _unchanged
+                    return source, filename, uptodate
+                if not debug:
+                    _remember(self.missing, key, _resolution_expires((template, )), resolution_cache_size)
                 raise TemplateNotFound(template)
 
         def assets_loader(template):
             if template.startswith(u'assets:') is False:
                 return None
-            template = template.replace(u'assets:', u'')
-            template = template.split('?')[0]
-            if template.startswith(u'/') is True:
-                template = template[1:]
+            path = _assets_path(template)
             try:
-                from plugins.code.models.code_model import get_source
-                from plugins.file.models.file_model import get_file
-                t = get_file(template)
-                if t is None:
-                    raise TemplateNotFound(template)
-                s = get_source(target=t, version=t.last_version)
-                if s is None:
-                    raise TemplateNotFound(template)
-                self.environment.globals.update({
-                    'code_version': t.last_version,
-                })
-                return s.source
+                version = _current_assets_version(path)
+                source = get_assets_source(path, version) if version is not None else None
             except:
                 raise TemplateNotFound(template)
+            if source is None:
+                raise TemplateNotFound(template)
+            generation = _assets_generation()
+
+            def uptodate():
+                if _assets_generation() != generation:
+                    return False
+                try:
+                    return _current_assets_version(path) == version
+                except:
+                    return False
+            return source, None, uptodate
+
+        module_loader = checksums = None
+        checksums_path = os.path.join(self._compiled_templates_path(), compiled_checksums_filename)
+        if use_compiled_templates and os.path.exists(checksums_path):
+            with open(checksums_path) as f:
+                checksums = json.load(f)
+            module_loader = jinja2.ModuleLoader(self._compiled_templates_path())
 
         loader = ChoiceLoader([
             jinja2.FunctionLoader(assets_loader),
@@ -121,9 +433,29 @@ class TemplateEngine(object):
             jinja2.PrefixLoader({
                 k: jinja2.FileSystemLoader(v)
                 for k, v in prefix_paths.iteritems()})
-        ])
+        ], module_loader=module_loader, checksums=checksums)
         return loader
 
+    def compile(self, target=None, log_function=None):
+        """
+        Compiles every file template of this engine into ``target`` (``compiled_templates_path``
+        by default), replacing the modules compiled before, and records the checksum of each
+        source so modules that no longer match their template are skipped.
+        """
+        path = self._compiled_templates_path(target)
+        if os.path.isdir(path):
+            for filename in os.listdir(path):
+                if filename.startswith('tmpl_') or filename == compiled_checksums_filename:
+                    os.remove(os.path.join(path, filename))
+        self.environment.compile_templates(
+            path, extensions=compiled_templates_extensions, zip=None, log_function=log_function)
+        checksums = {}
+        for name in self.environment.list_templates(extensions=compiled_templates_extensions):
+            if os.path.exists(os.path.join(path, jinja2.ModuleLoader.get_module_filename(name))):
+                checksums[name] = _checksum(self.environment.loader.get_source(self.environment, name)[0])
+        with open(os.path.join(path, compiled_checksums_filename), 'w') as f:
+            json.dump(checksums, f)
+
     def render(self, name, context=None):
         template = self.find(name)
         context = context if context else {}
@@ -133,6 +465,8 @@ class TemplateEngine(object):
             'list': name,
             'theme': self.theme
         }})
+        if template.name and template.name.startswith(u'assets:'):
+            context.setdefault('code_version', _current_assets_version(_assets_path(template.name)))
 
         events.fire('before_template_render', name=name, context=context, env=self.environment)
         result = template.render(context, context=context)
@@ -140,7 +474,25 @@ class TemplateEngine(object):
         return result
 
     def find(self, name):
-        return self.environment.get_or_select_template(name)
+        if isinstance(name, (basestring, jinja2.Template)):
+            return self.environment.get_or_select_template(name)
+        names = tuple(name)
+        key = _resolution_key(names)
+        resolved = self._resolved.get(key)
+        if resolved is not None and _is_fresh(resolved[1]):
+            try:
+                return self.environment.get_template(resolved[0])
+            except TemplateNotFound:
+                self._resolved.pop(key, None)
+        for index, item in enumerate(names):
+            try:
+                template = self.environment.get_template(item)
+            except TemplateNotFound:
+                continue
+            if not debug:
+                _remember(self._resolved, key, (item, _resolution_expires(names[:index])), resolution_cache_size)
+            return template
+        raise jinja2.TemplatesNotFound(names)
 
     def themed(self, name, theme=None):
         """
@@ -218,15 +570,21 @@ global_context = {}
 extra_paths = []
 
 
-def render_template(name, context=None, theme=None):
+def render_template(name, context=None, theme=None, cache=True):
     """
     Renders the template given by name with the given context (variables).
-    Uses the global context.
+    Uses the global context. Without ``cache`` the versions of ``assets:`` templates are
+    read from the datastore instead of memcache.
     """
     if context is None:
         context = {}
-    # TODO preload assets file
-    return _get_engine(theme=theme).render(name, context)
+    # Templates may render other templates (mails, widgets), each keeps its own state.
+    previous = getattr(_assets_local, 'render', None)
+    _assets_local.render = {'check': not cache, 'generation': None, 'versions': {}}
+    try:
+        return _get_engine(theme=theme).render(name, context)
+    finally:
+        _assets_local.render = previous
 
 
 def add_template_path(path_or_paths, prefix=None):
@@ -241,6 +599,27 @@ def add_template_path(path_or_paths, prefix=None):
     extra_paths.append((path_or_paths, prefix))
 
 
+def compile_templates(themes=None, target=None, log_function=logging.info):
+    """
+    Compiles the file templates of every theme into Python modules, meant to be run before
+    deploying, once the plugins have registered their template paths::
+
+        from argeweb.core import routing, template
+        routing.auto_route(app.router)
+        template.compile_templates()
+
+    With ``use_compiled_templates`` set, engines load them through a ``jinja2.ModuleLoader``
+    instead of parsing the sources, except templates edited since they were compiled.
+    """
+    if themes is None:
+        names = _get_engine().environment.list_templates(extensions=compiled_templates_extensions)
+        themes = [None] + sorted(set(
+            name.split('/')[1] for name in names if name.startswith('themes/') and name.count('/') > 1))
+    for theme in themes:
+        engine = TemplateEngine(theme=theme, extra_globals=global_context, extra_paths=extra_paths)
+        engine.compile(target, log_function=log_function)
+
+
 def _get_engine(theme=None):
     global engines
     global global_context
@@ -468,6 +468,10 @@ class TemplateView(View):
         self.theme = controller.theme
         self.setup_template_variables()
 
+    def setup_session_variables(self):
+        # 只有在輸出樣版時才建立 session store
+        self.context.set_dotted('this.session', self.controller.session)
+
     def setup_template_variables(self):
         self.context.get_dotted('this', {}).update({
             'uri': self.controller.uri,
@@ -513,7 +517,8 @@ class TemplateView(View):
     def render(self, *args, **kwargs):
         self.controller.events.before_render(controller=self.controller)
         self.context.update({'theme': self.theme})
-        result = template.render_template(self.get_template_names(), self.context, theme=self.theme)
+        self.setup_session_variables()
+        result = template.render_template(self.get_template_names(), self.context, theme=self.theme, cache=self.cache)
         self.controller.response.content_type = 'text/html'
         self.controller.response.charset = 'utf-8'
         self.controller.response.unicode_body = result
@@ -560,23 +565,7 @@ class TemplateView(View):
 
         """
         if self.template_name:
-            if self.cache:
-                return self.template_name
-            else:
-                # 使用隨機字串可以避開 Jinja2 樣版系統的快取
-                random_string = str(random.random())
-                return_list = []
-                for item in self.template_name:
-                    if str(item).startswith('assets:'):
-                        return_list.append(item + "?random_string=" + random_string)
-                    else:
-                        return_list.append(item)
-                return return_list
-        if self.cache:
-            random_string = ''
-        else:
-            # 使用隨機字串可以避開 Jinja2 樣版系統的快取
-            random_string = "?random_string=" + str(random.random())
+            return self.template_name
         templates = []
 
         template_path = '%s/' % self.controller.name
@@ -604,9 +593,9 @@ class TemplateView(View):
         for i in templates:
             lower = i.lower()
             if i not in templates_new:
-                templates_new.append(i+random_string)
+                templates_new.append(i)
             if lower not in templates_new:
-                templates_new.append(lower+random_string)
+                templates_new.append(lower)
         self.controller.events.template_names(controller=self.controller, templates=templates_new)
         return templates_new
 
@@ -696,7 +685,8 @@ class RenderView(TemplateView):
     def render(self, *args, **kwargs):
         self.controller.events.before_render(controller=self.controller)
         self.controller.response.charset = 'utf-8'
-        result = template.render_template(self.get_template_names(), self.context, theme=self.theme)
+        self.setup_session_variables()
+        result = template.render_template(self.get_template_names(), self.context, theme=self.theme, cache=self.cache)
         self.controller.response.unicode_body = result
         self.controller.events.after_render(controller=self.controller, result=result)
         return self.controller.response